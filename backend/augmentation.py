@@ -0,0 +1,83 @@
+import numpy as np
+
+# ITU-R 601-2 luma weights, same as PIL's "L" conversion
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def sample_augmentation_params(rng, n=1, contrast_factor=(1.0, 2.0), sharpness_factor=(1.0, 3.0),
+                               random_saturation_range=(0.5, 1.5)):
+    """
+    Draws `n` random (contrast, sharpness, saturation) triples.
+
+    Args:
+        rng (np.random.Generator): Source of randomness (seed it for reproducibility).
+
+    Returns:
+        np.ndarray: float32 array of shape (n, 3).
+    """
+    low = np.array([contrast_factor[0], sharpness_factor[0], random_saturation_range[0]], dtype=np.float32)
+    high = np.array([contrast_factor[1], sharpness_factor[1], random_saturation_range[1]], dtype=np.float32)
+    return rng.uniform(low, high, size=(n, 3)).astype(np.float32)
+
+
+def _smooth3x3(img):
+    """PIL's SMOOTH filter ([[1,1,1],[1,5,1],[1,1,1]] / 13); border pixels are left as-is"""
+    smoothed = img.copy()
+    inner = img[1:-1, 1:-1] * 5.0
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            if dy == 1 and dx == 1:
+                continue
+            inner += img[dy:dy + img.shape[0] - 2, dx:dx + img.shape[1] - 2]
+    inner /= 13.0
+    smoothed[1:-1, 1:-1] = inner
+    return smoothed
+
+
+def augment_batch(image, params, bgr=False):
+    """
+    Applies contrast, sharpness and saturation enhancement - the same blends as
+    PIL's ImageEnhance.Contrast -> Sharpness -> Color chain - for every row of
+    `params` in one fused pass per variant.
+
+    All three enhancements are linear blends, so they are folded into a single
+    expression over quantities computed once per image (grey mean, 3x3 smoothed
+    image, detail image and their luma). Values are clipped once at the end
+    rather than after every stage as PIL does.
+
+    Args:
+        image (np.ndarray): HxWx3 uint8 RGB image. Not modified.
+        params (np.ndarray): (N, 3) array of (contrast, sharpness, saturation) factors.
+        bgr (bool): Write the output channels in BGR order (what ultralytics
+            expects for numpy input).
+
+    Returns:
+        np.ndarray: (N, H, W, 3) uint8 array of augmented images.
+    """
+    img = np.asarray(image, dtype=np.float32)
+    params = np.atleast_2d(np.asarray(params, dtype=np.float32))
+
+    # Per-image terms shared by every variant
+    mean = float(int((img @ LUMA_WEIGHTS).mean() + 0.5))
+    smoothed = _smooth3x3(img)
+    detail = img - smoothed          # sharpness blends along this direction
+    smoothed -= mean                 # contrast blends around the grey mean
+    smoothed_luma = (smoothed @ LUMA_WEIGHTS)[..., None]
+    detail_luma = (detail @ LUMA_WEIGHTS)[..., None]
+
+    out = np.empty((len(params),) + img.shape, dtype=np.uint8)
+    buf = np.empty(img.shape, dtype=np.float32)
+    for n, (contrast, sharpness, saturation) in enumerate(params):
+        # contrast:   y = mean + c * (x - mean)
+        # sharpness:  y = smooth(y) + s * (y - smooth(y))
+        # saturation: y = luma(y) + k * (y - luma(y))
+        keep_colour = contrast * saturation
+        to_grey = contrast * (1.0 - saturation)
+        np.multiply(smoothed, keep_colour, out=buf)
+        buf += to_grey * smoothed_luma
+        buf += (keep_colour * sharpness) * detail
+        buf += (to_grey * sharpness) * detail_luma
+        buf += mean
+        np.clip(buf, 0, 255, out=buf)
+        np.copyto(out[n], buf[..., ::-1] if bgr else buf, casting="unsafe")
+    return out
@@ -0,0 +1,93 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from dotenv import load_dotenv
+from functions import calculate_parasite_density
+from inference_backends import SUPPORTED_BACKENDS
+from model_registry import ModelRegistry
+
+load_dotenv()
+
+DEFAULT_IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_images")
+
+
+def run_backend(backend, image_paths, args):
+    """Load the three detectors for `backend` and time one full density calculation"""
+    registry = ModelRegistry(backend=backend)
+
+    load_start = time.time()
+    asexual_model, rbc_model, stage_model = registry.get_models()
+    load_seconds = time.time() - load_start
+
+    start = time.time()
+    result = calculate_parasite_density(
+        image_paths, asexual_model, rbc_model, stage_model,
+        args.target_rbc_count, args.repetitions,
+        batch_size=args.batch_size,
+        stack_repetitions=True,
+        seed=args.seed  # same augmentations for every backend
+    )
+    return result, load_seconds, time.time() - start
+
+
+def compare_results(reference, result):
+    """Absolute differences against the reference (PyTorch) result"""
+    stages = set(reference["average_stage_counts"]) | set(result["average_stage_counts"])
+    stage_diff = max(
+        (abs(reference["average_stage_counts"].get(s, 0) - result["average_stage_counts"].get(s, 0)) for s in stages),
+        default=0
+    )
+    return {
+        "parasitemia_diff": abs(reference["average_parasitemia_percent"] - result["average_parasitemia_percent"]),
+        "density_diff": abs(reference["average_parasite_density_per_1000_rbc"] - result["average_parasite_density_per_1000_rbc"]),
+        "max_stage_count_diff": stage_diff,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inference backends for parity and latency")
+    parser.add_argument("--backends", nargs="+", default=list(SUPPORTED_BACKENDS), choices=SUPPORTED_BACKENDS)
+    parser.add_argument("--images", default=DEFAULT_IMAGE_DIR, help="Directory of .jpg test images")
+    parser.add_argument("--target-rbc-count", type=int, default=1000)
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-parasitemia-diff", type=float, default=0.1,
+                        help="Fail if a backend's parasitemia differs from the first backend by more (percentage points)")
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))
+    if not image_paths:
+        print(f"❌ No .jpg images found in {args.images}")
+        return 1
+    print(f"Benchmarking {args.backends} on {len(image_paths)} images")
+
+    reference = None
+    parity_ok = True
+    for backend in args.backends:
+        result, load_seconds, run_seconds = run_backend(backend, image_paths, args)
+        if result is None:
+            print(f"❌ {backend}: no result")
+            parity_ok = False
+            continue
+
+        line = (f"{backend:>9}: load {load_seconds:6.1f}s | run {run_seconds:6.1f}s | "
+                f"parasitemia {result['average_parasitemia_percent']:.3f}%")
+        if reference is None:
+            reference = result
+        else:
+            diff = compare_results(reference, result)
+            line += (f" | Δparasitemia {diff['parasitemia_diff']:.3f} | Δdensity {diff['density_diff']:.2f}"
+                     f" | Δstage max {diff['max_stage_count_diff']}")
+            if diff["parasitemia_diff"] > args.max_parasitemia_diff:
+                parity_ok = False
+        print(line)
+
+    print("✅ Backends agree" if parity_ok else "❌ Parity check failed")
+    return 0 if parity_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from celery import Celery
 from dotenv import load_dotenv
 
@@ -23,7 +24,13 @@ celery_app.conf.update(
     task_reject_on_worker_lost=True,
     task_acks_late=True,
     worker_prefetch_multiplier=1,  # Only prefetch 1 task per worker
-    worker_max_tasks_per_child=3,  # Restart worker after 3 tasks (prevents memory leaks)
+    # Recycle workers occasionally (prevents memory leaks) without throwing away
+    # the warm model registry every few tasks
+    worker_max_tasks_per_child=int(os.getenv("WORKER_MAX_TASKS_PER_CHILD", "50")),
+    # worker_process_init loads, warms up (and with INFERENCE_BACKEND=onnx/openvino
+    # may first export) the models before the child reports ready; the 4 s default
+    # would kill it mid-load and restart it forever
+    worker_proc_alive_timeout=float(os.getenv("WORKER_PROC_ALIVE_TIMEOUT", "300")),
     # Fixed concurrency
     worker_concurrency=2,  # 2 workers
     # Auto-retry settings
@@ -34,5 +41,18 @@ celery_app.conf.update(
     }
 )
 
-# Empty beat schedule
-celery_app.conf.beat_schedule = {}
+# Periodic maintenance (run by the celery-beat service)
+celery_app.conf.beat_schedule = {
+    "cleanup-orphaned-tasks": {
+        "task": "tasks.cleanup_orphaned_tasks",
+        "schedule": float(os.getenv("ORPHAN_CLEANUP_INTERVAL_SECONDS", "300")),
+    },
+    "delete-expired-tasks": {
+        "task": "tasks.delete_expired_tasks",
+        "schedule": float(os.getenv("EXPIRED_TASK_CLEANUP_INTERVAL_SECONDS", "900")),
+    },
+    "sweep-old-images": {
+        "task": "tasks.sweep_old_images",
+        "schedule": timedelta(hours=float(os.getenv("IMAGE_SWEEP_INTERVAL_HOURS", "6"))),
+    },
+}
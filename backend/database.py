@@ -1,15 +1,62 @@
 import os
-from sqlalchemy import inspect, create_engine, Column, Text, DateTime, JSON, Text
+import json
+from sqlalchemy import inspect, create_engine, text, select, update, and_, or_, Column, Text, DateTime, JSON, Index
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+
+# Async drivers for the API's engine (DATABASE_URL keeps the sync driver)
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def async_database_url(url):
+    """
+    (url, connect_args) for the async engine: ASYNC_DATABASE_URL as given, or
+    DATABASE_URL with its driver swapped for the async one. asyncpg rejects libpq's
+    sslmode query parameter, so it is passed on as asyncpg's ssl argument instead.
+    """
+    if os.getenv("ASYNC_DATABASE_URL"):
+        return os.getenv("ASYNC_DATABASE_URL"), {}
+    async_url = make_url(url)
+    async_url = async_url.set(drivername=_ASYNC_DRIVERS.get(async_url.drivername, async_url.drivername))
+    connect_args = {}
+    if async_url.drivername == "postgresql+asyncpg" and "sslmode" in async_url.query:
+        # asyncpg accepts the libpq mode names (disable/prefer/require/verify-full...)
+        connect_args["ssl"] = async_url.query["sslmode"]
+        async_url = async_url.difference_update_query(["sslmode"])
+    return async_url, connect_args
+
+def pool_settings(prefix, default_size):
+    """Pool sizing from {prefix}POOL_SIZE / MAX_OVERFLOW / POOL_TIMEOUT / POOL_RECYCLE / POOL_PRE_PING"""
+    if DATABASE_URL.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv(f"{prefix}POOL_SIZE", str(default_size))),
+        "max_overflow": int(os.getenv(f"{prefix}MAX_OVERFLOW", "5")),
+        "pool_timeout": float(os.getenv(f"{prefix}POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv(f"{prefix}POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv(f"{prefix}POOL_PRE_PING", "true").lower() == "true",
+    }
+
+# Sync engine: Celery workers, startup checks. One connection per worker process is plenty.
+engine = create_engine(DATABASE_URL, **pool_settings("WORKER_DB_", 2))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine: FastAPI endpoints, so DB I/O no longer blocks the event loop
+_async_url, _async_connect_args = async_database_url(DATABASE_URL)
+async_engine = create_async_engine(_async_url, connect_args=_async_connect_args, **pool_settings("DB_", 10))
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
 class User(Base):
@@ -36,6 +83,63 @@ class Task(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     last_chat_history = Column(Text, nullable=True)
     ai_report = Column(Text, nullable=True)  # ✅ NEW: Cached AI report
+    summary = Column(JSON, nullable=True)  # Compact result for the task list (see result_summary)
+    progress = Column(JSON, nullable=True)  # Latest inference progress (see tasks.ProgressReporter)
+    
+    __table_args__ = (
+        # GET /tasks: one user's tasks, newest first, paged by created_at
+        Index("ix_tasks_user_id_created_at", "user_id", "created_at"),
+    )
+
+def result_summary(result):
+    """Compact view of a task result stored in Task.summary for the task list"""
+    if result is None:
+        return None
+    if "error" in result:
+        return {"error": result["error"]}
+    return {
+        "average_parasitemia_percent": float(result["average_parasitemia_percent"]),
+        "average_parasite_density_per_1000_rbc": float(result["average_parasite_density_per_1000_rbc"]),
+        "average_stage_counts": result["average_stage_counts"],
+        # Results stored before adaptive repetitions only list their runs
+        "repetitions_run": result.get("repetitions_run", len(result.get("all_run_results", []))),
+    }
+
+def task_page_query(user_id, limit, after=None):
+    """
+    Summary columns of one page of a user's tasks, newest first, through the
+    (user_id, created_at) index. `after` is the (created_at, id) of the last task
+    of the previous page; ties on created_at are broken by id. Selects limit + 1
+    rows so the caller can tell whether there is a next page.
+    """
+    query = select(
+        Task.id, Task.status, Task.created_at, Task.patient_name, Task.date, Task.summary
+    ).where(Task.user_id == user_id)
+    if after is not None:
+        after_created_at, after_id = after
+        query = query.where(or_(
+            Task.created_at < after_created_at,
+            and_(Task.created_at == after_created_at, Task.id < after_id)
+        ))
+    return query.order_by(Task.created_at.desc(), Task.id.desc()).limit(limit + 1)
+
+def backfill_task_summaries():
+    """One-time fill of Task.summary from the stored results of existing tasks"""
+    filled = 0
+    with engine.begin() as conn:
+        rows = conn.execute(select(Task.id, Task.result).where(Task.result.isnot(None))).all()
+        for task_id, result in rows:
+            try:
+                # Results are stored JSON-encoded inside the JSON column
+                if isinstance(result, str):
+                    result = json.loads(result)
+                summary = result_summary(result) if isinstance(result, dict) else None
+            except (ValueError, KeyError, TypeError):
+                summary = None  # e.g. {"status": "processing_started"}
+            if summary is not None:
+                conn.execute(update(Task).where(Task.id == task_id).values(summary=summary))
+                filled += 1
+    return filled
 
 try:
     inspector = inspect(engine)
@@ -51,6 +155,19 @@ try:
     else:
         print("✅ All required tables already exist - skipping creation")
         
+        # Lightweight migrations for tables created before these existed
+        task_columns = {column["name"] for column in inspector.get_columns("tasks")}
+        for column_name in ("summary", "progress"):
+            if column_name not in task_columns:
+                column_type = Task.__table__.c[column_name].type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE tasks ADD COLUMN {column_name} {column_type}"))
+                print(f"✅ Added tasks.{column_name} column")
+                if column_name == "summary":
+                    print(f"✅ Backfilled summaries for {backfill_task_summaries()} tasks")
+        for index in Task.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+        
 except Exception as e:
     print(f"❌ Database check/creation failed: {e}")
 
@@ -60,4 +177,8 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
\ No newline at end of file
@@ -0,0 +1,235 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+
+DETECTION_CACHE_TTL_SECONDS = int(os.getenv("DETECTION_CACHE_TTL_HOURS", "168")) * 3600
+DETECTION_CACHE_DIR = os.getenv("DETECTION_CACHE_DIR", "/tmp/detection_cache")
+DETECTION_CACHE_MAX_BYTES = int(os.getenv("DETECTION_CACHE_MAX_MB", "512")) * 1024 * 1024
+DETECTION_CACHE_MAX_ENTRIES = int(os.getenv("DETECTION_CACHE_MAX_ENTRIES", "500000"))
+
+_REDIS_PREFIX = "detcache:"
+_REDIS_LRU_KEY = "detcache:lru"  # sorted set: entry key -> last access time
+
+
+def image_content_hash(image_path_or_bytes):
+    """SHA-256 of the encoded image (file contents for a path)"""
+    digest = hashlib.sha256()
+    if isinstance(image_path_or_bytes, str):
+        with open(image_path_or_bytes, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(image_path_or_bytes)
+    return digest.hexdigest()
+
+
+def detection_cache_key(image_hash, augmentation_params, model_version, variant):
+    """
+    One model's detections on one augmented frame are fully determined by the
+    source image, the augmentation parameters (what the seed produced), the
+    model weights/backend/precision and how the frame was predicted (`variant`,
+    e.g. the tiling settings).
+    """
+    digest = hashlib.sha256()
+    for part in (image_hash, model_version, variant):
+        digest.update(str(part).encode())
+        digest.update(b"|")
+    digest.update(np.asarray(augmentation_params, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def _encode(detections):
+    boxes, scores, classes = detections
+    rows = np.concatenate([
+        np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+        np.asarray(scores, dtype=np.float32).reshape(-1, 1),
+        np.asarray(classes, dtype=np.float32).reshape(-1, 1),
+    ], axis=1)
+    return rows.tobytes()
+
+
+def _decode(payload):
+    rows = np.frombuffer(payload, dtype=np.float32).reshape(-1, 6)
+    return rows[:, :4].copy(), rows[:, 4].copy(), rows[:, 5].astype(np.int64)
+
+
+class DetectionCache:
+    """
+    Persistent cache of raw per-frame detections (boxes, confidences, class IDs),
+    shared by all worker processes so retries and resubmitted images skip predict.
+
+    Backed by Redis (DETECTION_CACHE_REDIS_URL; entries expire after DETECTION_CACHE_TTL_HOURS and
+    the least recently used are dropped beyond DETECTION_CACHE_MAX_ENTRIES) or a
+    local directory (files expire after the same TTL and the least recently used
+    are dropped beyond DETECTION_CACHE_MAX_MB). Cache errors are logged and
+    treated as misses - the cache never fails a task.
+    """
+
+    def __init__(self, backend="disk", redis_url=None, cache_dir=DETECTION_CACHE_DIR,
+                 ttl_seconds=DETECTION_CACHE_TTL_SECONDS, max_bytes=DETECTION_CACHE_MAX_BYTES,
+                 max_entries=DETECTION_CACHE_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._disk_bytes = None  # lazily measured
+        # _StagePass may store from its executor thread while the task thread looks up
+        self._disk_lock = threading.Lock()
+        if backend == "redis":
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # --- lookup ---
+    def get_many(self, keys):
+        """Cached detections per key, None for misses"""
+        try:
+            if self.backend == "redis":
+                payloads = self._redis_get_many(keys)
+            else:
+                payloads = [self._disk_get(key) for key in keys]
+        except Exception as e:
+            print(f"⚠️ Detection cache lookup failed: {e}")
+            payloads = [None] * len(keys)
+
+        found = sum(1 for p in payloads if p is not None)
+        self.hits += found
+        self.misses += len(keys) - found
+        return [_decode(p) if p is not None else None for p in payloads]
+
+    def put_many(self, entries):
+        """Store {key: (boxes, scores, classes)}"""
+        if not entries:
+            return
+        try:
+            payloads = {key: _encode(detections) for key, detections in entries.items()}
+            if self.backend == "redis":
+                self._redis_put_many(payloads)
+            else:
+                for key, payload in payloads.items():
+                    self._disk_put(key, payload)
+                with self._disk_lock:
+                    self._evict_disk()
+        except Exception as e:
+            print(f"⚠️ Detection cache store failed: {e}")
+
+    # --- Redis ---
+    def _redis_get_many(self, keys):
+        if not keys:
+            return []
+        payloads = self._redis.mget([_REDIS_PREFIX + key for key in keys])
+        hit_keys = {key: time.time() for key, p in zip(keys, payloads) if p is not None}
+        if hit_keys:
+            self._redis.zadd(_REDIS_LRU_KEY, hit_keys)
+        return payloads
+
+    def _redis_put_many(self, payloads):
+        now = time.time()
+        pipe = self._redis.pipeline(transaction=False)
+        for key, payload in payloads.items():
+            pipe.set(_REDIS_PREFIX + key, payload, ex=self.ttl_seconds)
+        pipe.zadd(_REDIS_LRU_KEY, {key: now for key in payloads})
+        # Index members whose entries have already expired
+        pipe.zremrangebyscore(_REDIS_LRU_KEY, 0, now - self.ttl_seconds)
+        pipe.zcard(_REDIS_LRU_KEY)
+        size = pipe.execute()[-1]
+
+        overflow = size - self.max_entries
+        if overflow > 0:
+            evicted = [key.decode() if isinstance(key, bytes) else key
+                       for key, _ in self._redis.zpopmin(_REDIS_LRU_KEY, overflow)]
+            if evicted:
+                self._redis.delete(*[_REDIS_PREFIX + key for key in evicted])
+
+    # --- local disk ---
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.bin")
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                payload = f.read()
+            os.utime(path)  # mtime doubles as last-access time for eviction
+            return payload
+        except FileNotFoundError:
+            return None
+
+    def _disk_put(self, key, payload):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so concurrent workers never read a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        with self._disk_lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(payload)
+
+    def _evict_disk(self):
+        """Called with _disk_lock held"""
+        if self._disk_bytes is not None and self._disk_bytes <= self.max_bytes:
+            return
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        now = time.time()
+        total = 0
+        kept = []
+        for mtime, size, path in entries:
+            if now - mtime > self.ttl_seconds:
+                self._remove(path)
+            else:
+                kept.append((mtime, size, path))
+                total += size
+
+        # Trim to 90% so eviction doesn't run again on the very next put
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(kept):
+                if total <= self.max_bytes * 0.9:
+                    break
+                self._remove(path)
+                total -= size
+        self._disk_bytes = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_detection_cache():
+    """
+    DetectionCache selected by DETECTION_CACHE: "redis" (default when
+    DETECTION_CACHE_REDIS_URL is set), "disk" or "off" (returns None).
+    The cache gets its own Redis so its entries never compete with the
+    Celery broker for memory.
+    """
+    redis_url = os.getenv("DETECTION_CACHE_REDIS_URL")
+    backend = os.getenv("DETECTION_CACHE", "redis" if redis_url else "disk").lower()
+    if backend == "off":
+        return None
+    try:
+        return DetectionCache(backend=backend, redis_url=redis_url)
+    except Exception as e:
+        print(f"⚠️ Detection cache unavailable ({backend}): {e}")
+        return None
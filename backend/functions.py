@@ -1,63 +1,507 @@
-import random
 import io
 from collections import Counter, defaultdict
-from PIL import Image, ImageEnhance, ImageOps
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
 
 from ultralytics import YOLO
 import json
 import numpy as np # For averaging
 import torch 
+from scipy import stats
+from image_cache import DecodedImageCache
+from augmentation import augment_batch, sample_augmentation_params
+from tiling import tile_windows, merge_tile_detections
+from detection_cache import detection_cache_key, image_content_hash
 stage_map ={"red blood cell": 0, "trophozoite": 1, "schizont": 2, "ring": 3, "difficult": 4,"gametocyte":5,"leukocyte":6}
+_default_rng = np.random.default_rng()
+
+
+def _frame_rng(seed, rep, image_index):
+    """Augmentation RNG for one (repetition, image) frame - reproducible when seeded"""
+    if seed is None:
+        return _default_rng
+    return np.random.default_rng([seed, rep, image_index])
+
+# --- Image Decoding ---
+def _decode_image(image_path_or_bytes, image_cache=None):
+    """
+    Decodes a file path or image bytes to an RGB image. With an `image_cache`
+    the shared read-only RGB array from the cache is returned, otherwise a PIL
+    image. Already-decoded PIL images / arrays are passed through.
+    Returns None if the image cannot be read.
+    """
+    try:
+        if isinstance(image_path_or_bytes, (Image.Image, np.ndarray)):
+            return image_path_or_bytes
+        if image_cache is not None and isinstance(image_path_or_bytes, (str, bytes, bytearray, memoryview)):
+            return image_cache.get(image_path_or_bytes)
+        if isinstance(image_path_or_bytes, str):
+            return Image.open(image_path_or_bytes).convert("RGB")
+        if isinstance(image_path_or_bytes, (bytes, bytearray, memoryview)):
+            return Image.open(io.BytesIO(image_path_or_bytes)).convert("RGB")
+        print("Error: Input must be a file path (str) or image bytes (bytes-like).")
+        return None
+    except FileNotFoundError:
+        print(f"Error: Image not found at {image_path_or_bytes}")
+        return None
+    except Exception as e:
+        print(f"An error occurred while decoding image: {e}")
+        return None
+
+
 # --- Provided Augmentation Function ---
-def augment_microscopic_image(image_path_or_bytes, contrast_factor=(1.0, 2.0), sharpness_factor=(1.0, 3.0), random_saturation_range=(0.5, 1.5)):
+def augment_microscopic_image(image_path_or_bytes, contrast_factor=(1.0, 2.0), sharpness_factor=(1.0, 3.0), random_saturation_range=(0.5, 1.5), rng=None):
     """
     Applies random augmentations to a microscopic image: contrast enhancement,
-    sharpening, random saturation, and potentially converts it to grayscale.
+    sharpening and random saturation (see augmentation.augment_batch).
 
     Args:
-        image_path_or_bytes (str or bytes): Path to the input image file or image bytes.
+        image_path_or_bytes (str, bytes, PIL.Image.Image or np.ndarray): Path to the input
+            image file, image bytes, or an already decoded RGB image (left unmodified).
         contrast_factor (tuple): Range (min, max) for random contrast enhancement.
         sharpness_factor (tuple): Range (min, max) for random sharpness enhancement.
         random_saturation_range (tuple): Range (min, max) for random saturation adjustment.
+        rng (np.random.Generator, optional): Random source, for reproducible augmentation.
 
     Returns:
         PIL.Image.Image: The augmented RGB PIL image, or None if an error occurs.
                          (Returning RGB as YOLO models typically expect it).
     """
     try:
-        if isinstance(image_path_or_bytes, str):
-            img = Image.open(image_path_or_bytes).convert("RGB")
-        elif isinstance(image_path_or_bytes, bytes):
-            img = Image.open(io.BytesIO(image_path_or_bytes)).convert("RGB")
-        else:
-            print("Error: Input must be a file path (str) or image bytes.")
+        img = _decode_image(image_path_or_bytes)
+        if img is None:
             return None
 
         # Apply augmentations
-        contrast = random.uniform(contrast_factor[0], contrast_factor[1])
-        enhancer_contrast = ImageEnhance.Contrast(img)
-        img = enhancer_contrast.enhance(contrast)
-
-        sharpness = random.uniform(sharpness_factor[0], sharpness_factor[1])
-        enhancer_sharpness = ImageEnhance.Sharpness(img)
-        img = enhancer_sharpness.enhance(sharpness)
-
-        saturation = random.uniform(random_saturation_range[0], random_saturation_range[1])
-        enhancer_saturation = ImageEnhance.Color(img)
-        img = enhancer_saturation.enhance(saturation)
-
+        params = sample_augmentation_params(
+            rng or _default_rng, 1, contrast_factor, sharpness_factor, random_saturation_range
+        )
+        augmented = augment_batch(np.asarray(img), params)[0]
 
         # Return the augmented RGB image
-        return img
+        return Image.fromarray(augmented)
 
-    except FileNotFoundError:
-        print(f"Error: Image not found at {image_path_or_bytes}")
-        return None
     except Exception as e:
         print(f"An error occurred during augmentation: {e}")
         return None
         
 
+# --- Batched Prediction Helpers ---
+_EMPTY_DETECTIONS = (np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64))
+
+
+def _detections_from_result(result):
+    """(xyxy boxes, confidences, class IDs) numpy arrays for one ultralytics result"""
+    if result.boxes and result.boxes.cls is not None:
+        boxes = result.boxes
+        return boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.int().cpu().numpy()
+    return _EMPTY_DETECTIONS
+
+
+def _predict_detections(model, frames, failed=None):
+    """
+    Runs one batched predict over `frames` and returns the detections per frame.
+
+    If the batched call fails each frame is retried on its own, so a single bad
+    frame only loses its own detections, like the old per-image loop. Indices of
+    frames that could not be predicted are added to the `failed` set, if given.
+    """
+    try:
+        return [_detections_from_result(r) for r in model.predict(frames, verbose=False)]
+    except Exception:
+        detections = []
+        for j, frame in enumerate(frames):
+            try:
+                results = model.predict(frame, verbose=False)
+                detections.append(_detections_from_result(results[0]) if results else _EMPTY_DETECTIONS)
+            except Exception:
+                detections.append(_EMPTY_DETECTIONS)
+                if failed is not None:
+                    failed.add(j)
+        return detections
+
+
+def _predict_detections_tiled(model, frames, tile_size, tile_overlap, merge_threshold, tile_batch_size, failed=None):
+    """
+    Like _predict_detections, but slices every frame into overlapping
+    `tile_size` tiles so small parasites survive the model's input resize.
+
+    Tiles from all frames are predicted `tile_batch_size` at a time (only that
+    many tile copies are alive at once), boxes are shifted back to frame
+    coordinates and cells seen by two tiles are merged (tiling.merge_tile_detections).
+    A frame is reported in `failed` if any of its tiles failed.
+    """
+    jobs = [
+        (f, window)
+        for f, frame in enumerate(frames)
+        for window in tile_windows(frame.shape[0], frame.shape[1], tile_size, tile_overlap)
+    ]
+    per_frame = [[] for _ in frames]
+    for start in range(0, len(jobs), tile_batch_size):
+        chunk = jobs[start:start + tile_batch_size]
+        tiles = [np.ascontiguousarray(frames[f][y0:y1, x0:x1]) for f, (x0, y0, x1, y1) in chunk]
+        failed_tiles = set()
+        chunk_detections = _predict_detections(model, tiles, failed_tiles)
+        if failed is not None:
+            failed.update(chunk[t][0] for t in failed_tiles)
+        for tile_id, ((f, (x0, y0, _, _)), (boxes, scores, classes)) in enumerate(
+                zip(chunk, chunk_detections), start):
+            offset = np.array([x0, y0, x0, y0], dtype=boxes.dtype)
+            per_frame[f].append((boxes + offset, scores, classes, np.full(len(boxes), tile_id)))
+
+    merged = []
+    for parts in per_frame:
+        if not parts:
+            merged.append(_EMPTY_DETECTIONS)
+            continue
+        boxes, scores, classes, tile_ids = (np.concatenate(column) for column in zip(*parts))
+        keep = merge_tile_detections(boxes, scores, classes, tile_ids, merge_threshold)
+        merged.append((boxes[keep], scores[keep], classes[keep]))
+    return merged
+
+
+def _cached_predict(detection_cache, model_version, variant, frames, frame_keys, predict):
+    """
+    Detections per frame, taken from `detection_cache` where possible; only the
+    misses go through `predict(frames, failed)`. Frames without a key (None) are
+    never cached, and neither are frames whose prediction failed.
+    """
+    keys = [
+        detection_cache_key(key[0], key[1], model_version, variant) if key is not None else None
+        for key in frame_keys
+    ]
+    lookup = [j for j, key in enumerate(keys) if key is not None]
+    detections = [None] * len(frames)
+    for j, cached in zip(lookup, detection_cache.get_many([keys[j] for j in lookup])):
+        detections[j] = cached
+
+    missing = [j for j, d in enumerate(detections) if d is None]
+    if missing:
+        failed = set()
+        fresh = predict([frames[j] for j in missing], failed)
+        for j, d in zip(missing, fresh):
+            detections[j] = d
+        detection_cache.put_many({
+            keys[j]: d for m, (j, d) in enumerate(zip(missing, fresh))
+            if keys[j] is not None and m not in failed
+        })
+    return detections
+
+
+class _CellCounter:
+    """
+    Turns a batch of frames into per-frame (parasite, uninfected RBC) counts.
+
+    Either two detectors (asexual parasite model: every detection is a parasite;
+    RBC model: detections of `rbc_class_id`) or one combined detector carrying both
+    class sets, so each frame is preprocessed and run through a backbone once.
+    With `tile_size` set, frames are predicted tile by tile (see
+    _predict_detections_tiled) before counting; `predict` applies the same
+    tiling to other models (the stage pass).
+    With a `detection_cache`, models with an entry in `model_versions` reuse
+    detections stored for the same image, augmentation and weights.
+    """
+
+    def __init__(self, asexual_parasite_model, rbc_model, rbc_class_id,
+                 combined_model=None, combined_parasite_class_ids=None, combined_rbc_class_id=0,
+                 tile_size=None, tile_overlap=0.2, tile_merge_threshold=0.5, tile_batch_size=8,
+                 detection_cache=None, model_versions=None):
+        self.asexual_parasite_model = asexual_parasite_model
+        self.rbc_model = rbc_model
+        self.rbc_class_id = rbc_class_id
+        self.combined_model = combined_model
+        self.combined_parasite_class_ids = (
+            set(combined_parasite_class_ids) if combined_parasite_class_ids is not None else None
+        )
+        self.combined_rbc_class_id = combined_rbc_class_id
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_merge_threshold = tile_merge_threshold
+        self.tile_batch_size = tile_batch_size
+        self.detection_cache = detection_cache
+        self.model_versions = model_versions or {}
+        # How frames are predicted, part of the detection cache key
+        self.variant = f"tiled:{tile_size}:{tile_overlap}:{tile_merge_threshold}" if tile_size else "full"
+
+    def predict(self, model, frames, failed=None):
+        if self.tile_size:
+            return _predict_detections_tiled(
+                model, frames, self.tile_size, self.tile_overlap,
+                self.tile_merge_threshold, self.tile_batch_size, failed
+            )
+        return _predict_detections(model, frames, failed)
+
+    def _predict_classes(self, name, model, frames, frame_keys=None):
+        """Detected class IDs per frame"""
+        if self.detection_cache is not None and frame_keys is not None and name in self.model_versions:
+            detections = _cached_predict(
+                self.detection_cache, self.model_versions[name], self.variant, frames, frame_keys,
+                lambda missing_frames, failed: self.predict(model, missing_frames, failed)
+            )
+        else:
+            detections = self.predict(model, frames)
+        return [classes.tolist() for _, _, classes in detections]
+
+    def _is_combined_parasite(self, class_id):
+        if self.combined_parasite_class_ids is None:
+            # Default: every class that is not the RBC class is a parasite
+            return class_id != self.combined_rbc_class_id
+        return class_id in self.combined_parasite_class_ids
+
+    def count(self, frames, frame_keys=None):
+        """
+        Returns (parasite_counts, rbc_counts), one entry per frame.
+        `frame_keys` are optional (image content hash, augmentation params) pairs
+        identifying each frame for the detection cache.
+        """
+        if self.combined_model is not None:
+            detections = self._predict_classes("combined", self.combined_model, frames, frame_keys)
+            parasite_counts = [sum(1 for c in d if self._is_combined_parasite(c)) for d in detections]
+            rbc_counts = [d.count(self.combined_rbc_class_id) for d in detections]
+            return parasite_counts, rbc_counts
+
+        parasite_counts = [len(d) for d in self._predict_classes("asexual", self.asexual_parasite_model, frames, frame_keys)]
+        rbc_counts = [d.count(self.rbc_class_id) for d in self._predict_classes("rbc", self.rbc_model, frames, frame_keys)]
+        return parasite_counts, rbc_counts
+
+
+# --- Counting Pass ---
+class _ImageSource:
+    """
+    Indexable view over a list of images or a lazily consumed iterable (e.g. a
+    download stream). Items are pulled from the iterable only when first
+    indexed and kept for later repetitions.
+    `known_hashes` may give the content hash of some images up front (None
+    entries are hashed on demand).
+    """
+
+    def __init__(self, images, known_hashes=None):
+        if isinstance(images, (list, tuple)):
+            self._items = list(images)
+            self._iterator = None
+        else:
+            self._items = []
+            self._iterator = iter(images)
+        self._content_hashes = {
+            i: content_hash for i, content_hash in enumerate(known_hashes or []) if content_hash
+        }
+
+    def has(self, i):
+        while i >= len(self._items) and self._iterator is not None:
+            try:
+                self._items.append(next(self._iterator))
+            except StopIteration:
+                self._iterator = None
+        return i < len(self._items)
+
+    def __getitem__(self, i):
+        self.has(i)
+        return self._items[i]
+
+    def content_hash(self, i):
+        """SHA-256 of image i's encoded bytes (None for already-decoded images)"""
+        if i not in self._content_hashes:
+            item = self[i]
+            try:
+                self._content_hashes[i] = (
+                    image_content_hash(item) if isinstance(item, (str, bytes, bytearray, memoryview)) else None
+                )
+            except OSError:
+                self._content_hashes[i] = None
+        return self._content_hashes[i]
+
+    def close(self):
+        """Stop consuming; generator sources are closed so they can cancel pending work"""
+        if self._iterator is not None and hasattr(self._iterator, "close"):
+            self._iterator.close()
+        self._iterator = None
+
+
+def _new_run_state(rep):
+    return {
+        "repetition": rep,
+        "parasite_count": 0,
+        "rbc_count": 0,
+        "images_processed": 0,
+        "contributing_images": [], # Indices into image_list counted in this run
+        "stage_counts_raw": Counter(), # Stores {class_id: count} for this run
+    }
+
+
+def _run_parasitemia(run):
+    total_rbcs_examined = run["parasite_count"] + run["rbc_count"]
+    return (run["parasite_count"] / total_rbcs_examined * 100) if total_rbcs_examined > 0 else 0.0
+
+
+class _RunningStats:
+    """Welford running mean/variance of per-repetition parasitemia"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    def ci_half_width(self, confidence):
+        """Half-width of the Student-t confidence interval of the mean"""
+        if self.n < 2:
+            return float("inf")
+        std_error = (self._m2 / (self.n - 1)) ** 0.5 / self.n ** 0.5
+        return float(stats.t.ppf((1 + confidence) / 2, self.n - 1) * std_error)
+
+
+class _StagePass:
+    """
+    Feeds the frames counted by the counting pass to the stage model in
+    bounded batches, so augmentation is not redone and at most
+    `max_in_flight` batches of frames are held at any time.
+
+    With an `executor` the stage predictions run on that thread while the
+    counting models keep going on the caller's thread.
+    `predict(model, frames, failed)` defaults to whole-frame prediction; pass
+    _CellCounter.predict (and its `variant`) to tile stage frames like the counting ones.
+    With a `detection_cache` and `model_version`, cached stage detections are reused.
+    """
+
+    def __init__(self, model, batch_size, executor=None, max_in_flight=2,
+                 detection_cache=None, model_version=None, predict=_predict_detections, variant="full"):
+        self.model = model
+        self.batch_size = batch_size
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.detection_cache = detection_cache
+        self.model_version = model_version
+        self.predict = predict
+        self.variant = variant
+        self._pending = [] # (run, frame, frame_key)
+        self._futures = []
+
+    def add(self, run, frame, frame_key=None):
+        self._pending.append((run, frame, frame_key))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        if self.executor is None:
+            self._predict(batch)
+            return
+        # Back-pressure: don't let queued frames pile up if the stage model is slower
+        while len(self._futures) >= self.max_in_flight:
+            self._futures.pop(0).result()
+        self._futures.append(self.executor.submit(self._predict, batch))
+
+    def _predict(self, batch):
+        try:
+            frames = [frame for _, frame, _ in batch]
+            if self.detection_cache is not None and self.model_version is not None:
+                detections = _cached_predict(
+                    self.detection_cache, self.model_version, self.variant, frames,
+                    [frame_key for _, _, frame_key in batch],
+                    lambda missing_frames, failed: self.predict(self.model, missing_frames, failed)
+                )
+            else:
+                detections = self.predict(self.model, frames)
+            for (run, _, _), (_, _, detected_classes) in zip(batch, detections):
+                # Count occurrences of each relevant stage class ID
+                run["stage_counts_raw"].update(Counter(detected_classes.tolist()))
+        except Exception as e:
+            print(f"Stage prediction failed for a batch of {len(batch)} frames: {e}")
+
+    def finish(self):
+        """Flush the last partial batch and wait for outstanding predictions"""
+        self._flush()
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+
+def _run_counting_pass(image_list, runs, cell_counter, target_rbc_count,
+                       batch_size, image_cache, seed, stage_pass=None, on_batch=None):
+    """
+    Counts parasites and uninfected RBCs for one or more repetitions in lock-step.
+
+    Images are taken `batch_size` at a time; each image is decoded once (through
+    `image_cache`) and augmented for every repetition that has not reached
+    `target_rbc_count` yet in one vectorized augment_batch call, and all those
+    frames go through each model of `cell_counter` in a single predict call.
+    Counts are then replayed frame by frame so every repetition stops at
+    exactly the image a one-by-one loop would have.
+    Counted frames are handed to `stage_pass` (if given) for stage prediction.
+    `on_batch(runs)`, if given, is called after every batch.
+    When `cell_counter` has a detection cache, every frame is keyed by its image
+    content hash and augmentation parameters.
+    Updates the dicts in `runs` in place.
+    """
+    use_detection_cache = cell_counter.detection_cache is not None
+    def reached_target(run):
+        return run["parasite_count"] + run["rbc_count"] >= target_rbc_count
+
+    batch_start = 0
+    while image_list.has(batch_start):
+        active_runs = [run for run in runs if not reached_target(run)]
+        if not active_runs:
+            break
+        batch_end = batch_start + batch_size
+
+        # --- 1. Augmentation ---
+        frame_owners = [] # (run, image index) for each frame, image-major order
+        batch_frames = []
+        frame_keys = [] if use_detection_cache else None # (image hash, augmentation params) per frame
+        for i in range(batch_start, batch_end):
+            if not image_list.has(i):
+                break
+            decoded_img = _decode_image(image_list[i], image_cache)
+            if decoded_img is None:
+                continue
+            try:
+                params = np.concatenate([
+                    sample_augmentation_params(_frame_rng(seed, run["repetition"], i))
+                    for run in active_runs
+                ])
+                # BGR uint8 frames, ready for ultralytics' numpy input path
+                augmented_frames = augment_batch(np.asarray(decoded_img), params, bgr=True)
+            except Exception as e:
+                print(f"An error occurred during augmentation: {e}")
+                continue
+            for run, augmented_img, frame_params in zip(active_runs, augmented_frames, params):
+                frame_owners.append((run, i))
+                batch_frames.append(augmented_img)
+                if use_detection_cache:
+                    image_hash = image_list.content_hash(i)
+                    frame_keys.append((image_hash, frame_params) if image_hash is not None else None)
+
+        batch_start = batch_end
+        if not batch_frames:
+            continue
+
+        # --- 2./3. Prediction - Asexual Parasites and Uninfected RBCs (one call per model) ---
+        parasite_counts, rbc_counts = cell_counter.count(batch_frames, frame_keys)
+
+        # Replay the per-image early stop so exactly the images a one-by-one
+        # loop would have examined contribute to each run
+        for j, ((run, i), frame, parasites_in_image, rbcs_in_image) in enumerate(zip(
+                frame_owners, batch_frames, parasite_counts, rbc_counts)):
+            if reached_target(run):
+                continue
+            run["parasite_count"] += parasites_in_image
+            run["rbc_count"] += rbcs_in_image
+            run["images_processed"] += 1 # Count only successfully augmented images
+            run["contributing_images"].append(i)
+            if stage_pass is not None:
+                stage_pass.add(run, frame, frame_keys[j] if use_detection_cache else None)
+
+        if on_batch is not None:
+            on_batch(runs)
+
+
 # --- Main Counting Function ---
 def calculate_parasite_density(
     image_list,
@@ -68,36 +512,120 @@ def calculate_parasite_density(
     repetitions=5,
     parasite_class_id=0,
     rbc_class_id=0,
-    stage_class_map=stage_map # Example: {0: 'ring', 1: 'trophozoite', 2: 'schizont'}
+    stage_class_map=stage_map, # Example: {0: 'ring', 1: 'trophozoite', 2: 'schizont'}
+    batch_size=8,
+    stack_repetitions=False,
+    image_cache=None,
+    seed=None,
+    stage_batch_size=None,
+    stage_concurrent=False,
+    adaptive=False,
+    min_repetitions=2,
+    ci_tolerance=0.5,
+    confidence=0.95,
+    combined_model=None,
+    combined_parasite_class_ids=None,
+    combined_rbc_class_id=0,
+    tile_size=None,
+    tile_overlap=0.2,
+    tile_merge_threshold=0.5,
+    detection_cache=None,
+    model_versions=None,
+    progress_callback=None,
+    image_hashes=None
 ):
     """
     Calculates malaria parasite density using YOLO models, applying augmentation,
     and averaging results over multiple repetitions.
 
     Args:
-        image_list (list): A list of image file paths (str) or image bytes.
+        image_list (list or iterable): Image file paths (str) or in-memory image bytes
+            (bytes, bytearray or memoryview). An iterator
+            or generator is consumed lazily, so inference can start while later images
+            are still arriving; it is closed once no further images are needed.
         asexual_parasite_model (YOLO): Loaded YOLO model for detecting asexual parasites.
         rbc_model (YOLO): Loaded YOLO model for detecting uninfected RBCs.
         stage_specific_model (YOLO, optional): Loaded YOLO model for specific stages.
         target_rbc_count (int): Minimum total RBCs (parasitized + uninfected) to count.
-        repetitions (int): Number of times to repeat the counting process.
+        repetitions (int): Number of times to repeat the counting process
+            (the upper bound when `adaptive` is set).
         parasite_class_id (int): Class ID for parasites in asexual_parasite_model.
         rbc_class_id (int): Class ID for RBCs in rbc_model.
         stage_class_map (dict, optional): Mapping from class ID to stage name for stage_specific_model.
+        batch_size (int): Number of augmented images sent to each model per predict call.
+            The target_rbc_count early stop is checked per batch; counts are still
+            accumulated image by image so only images before the stop point contribute.
+        stack_repetitions (bool): Run all repetitions in one pass: each image is decoded
+            once and its augmented variants for every repetition are predicted together.
+            Per-repetition results are the same shape as the sequential mode.
+        image_cache (DecodedImageCache, optional): Decoded-image cache shared by the
+            counting and stage passes. A new per-call cache is created when omitted.
+        seed (int, optional): Seeds the augmentation of every (repetition, image) frame,
+            making results reproducible and identical between stacked and sequential modes.
+        stage_batch_size (int, optional): Max frames per stage model predict call
+            (defaults to batch_size). The stage model sees the exact augmented frames
+            counted by the counting pass.
+        stage_concurrent (bool): Run stage predictions on a separate thread,
+            overlapping with the counting models.
+        adaptive (bool): Stop repeating once the `confidence` interval of the mean
+            parasitemia is within +/- `ci_tolerance` percentage points. At least
+            `min_repetitions` and at most `repetitions` runs are done; the stopping
+            reason is reported in the result.
+        min_repetitions (int): Repetitions always run before checking convergence in adaptive mode.
+        ci_tolerance (float): Allowed confidence-interval half-width, in parasitemia percent.
+        confidence (float): Confidence level of the interval (e.g. 0.95).
+        combined_model (YOLO, optional): One detector trained on both parasite and RBC
+            classes. When given it replaces asexual_parasite_model and rbc_model (which
+            may be None) so every frame needs a single forward pass.
+        combined_parasite_class_ids (iterable, optional): Parasite class IDs of
+            combined_model. Defaults to every class except combined_rbc_class_id.
+        combined_rbc_class_id (int): Uninfected RBC class ID of combined_model.
+        tile_size (int, optional): Split each frame into overlapping tiles of this many
+            pixels for the counting and stage models, so small ring stages are not lost
+            when large smear photos are downsized. Tiles are batched batch_size at a time.
+        tile_overlap (float): Fraction of a tile shared with its neighbour.
+        tile_merge_threshold (float): Intersection-over-smaller-box above which two
+            same-class detections from different tiles count as one cell.
+        detection_cache (DetectionCache, optional): Persistent store of raw detections
+            keyed by image content hash, augmentation parameters and model version.
+            Cached frames skip predict, so a retry with the same `seed` (or a
+            resubmission of the same images in the same order) is mostly lookups.
+        model_versions (dict, optional): Version string per model name ("asexual",
+            "rbc", "stage", "combined"), e.g. from ModelRegistry.model_version.
+            Models without a version are never cached.
+        progress_callback (callable, optional): Called after every batch with a dict of
+            repetitions_completed / repetitions_total, the repetitions in progress,
+            images_processed and rbcs_counted (the least advanced of those
+            repetitions) and target_rbc_count. Exceptions it raises are logged
+            and ignored; throttling is up to the callback.
+        image_hashes (list, optional): Known SHA-256 per image (None where unknown), e.g.
+            read from content-addressed storage names; saves re-hashing those images
+            for the detection cache.
 
     Returns:
         dict: Results including average parasitemia, density, stage counts, and run details.
               Returns None on critical errors.
     """
-    if not image_list:
+    current_image_list = _ImageSource(image_list, image_hashes) # Process in given order (or shuffle if needed)
+    if not current_image_list.has(0):
         print("Error: Image list cannot be empty.")
         return None
-    if not isinstance(asexual_parasite_model, YOLO) or not isinstance(rbc_model, YOLO):
+    if combined_model is not None:
+        if not isinstance(combined_model, YOLO):
+            print("Error: combined_model must be a loaded YOLO model object.")
+            # return None # Commented out for testing with placeholders
+    elif not isinstance(asexual_parasite_model, YOLO) or not isinstance(rbc_model, YOLO):
          print("Error: asexual_parasite_model and rbc_model must be loaded YOLO model objects.")
          # return None # Commented out for testing with placeholders
     if stage_specific_model and not isinstance(stage_specific_model, YOLO):
          print("Error: stage_specific_model must be a loaded YOLO model object or None.")
          # return None # Commented out for testing with placeholders
+    if batch_size < 1:
+        print("Error: batch_size must be at least 1.")
+        return None
+    if adaptive and not 1 <= min_repetitions <= repetitions:
+        print("Error: min_repetitions must be between 1 and repetitions.")
+        return None
     if stage_specific_model and not stage_class_map:
         print("Error: 'stage_class_map' is required when using 'stage_specific_model'.")
         return None
@@ -106,72 +634,87 @@ def calculate_parasite_density(
     total_images_processed_per_run = []
     total_rbcs_counted_per_run = []
 
-
-    for rep in range(repetitions):
-        run_parasite_count = 0
-        run_rbc_count = 0
-        run_stage_counts_raw = Counter() # Stores {class_id: count} for this run
-        images_processed_this_run = 0
-
-        current_image_list = image_list # Process in given order (or shuffle if needed)
-
-        for i, image_data in enumerate(current_image_list):
-            current_total_rbcs = run_parasite_count + run_rbc_count
-            if current_total_rbcs >= target_rbc_count:
+    if image_cache is None:
+        image_cache = DecodedImageCache()
+    cell_counter = _CellCounter(
+        asexual_parasite_model, rbc_model, rbc_class_id,
+        combined_model, combined_parasite_class_ids, combined_rbc_class_id,
+        tile_size, tile_overlap, tile_merge_threshold, batch_size,
+        detection_cache, model_versions
+    )
+
+    # --- 1.-3. Augmentation + Counting (4. Stage prediction rides along) ---
+    # Stacked: every repetition advances through the images together, so each image
+    # is decoded once per pass and all its augmented variants share one predict call.
+    # Sequential: one repetition at a time (original behaviour).
+    # Adaptive: min_repetitions first, then one more at a time until the estimate converges.
+    all_runs = []
+    parasitemia_stats = _RunningStats()
+    stopping_reason = "fixed_repetitions"
+
+    repetitions_completed = 0
+
+    def report_progress(runs):
+        if progress_callback is None:
+            return
+        try:
+            progress_callback({
+                "repetitions_completed": repetitions_completed,
+                "repetitions_total": repetitions,
+                "repetitions_in_progress": [run["repetition"] + 1 for run in runs],
+                "images_processed": min(run["images_processed"] for run in runs),
+                "rbcs_counted": min(run["parasite_count"] + run["rbc_count"] for run in runs),
+                "target_rbc_count": target_rbc_count,
+            })
+        except Exception as e:
+            print(f"Progress callback failed: {e}")
+
+    stage_executor = ThreadPoolExecutor(max_workers=1) if stage_specific_model and stage_concurrent else None
+    stage_pass = _StagePass(
+        stage_specific_model, stage_batch_size or batch_size, stage_executor,
+        detection_cache=detection_cache, model_version=(model_versions or {}).get("stage"),
+        predict=cell_counter.predict, variant=cell_counter.variant
+    ) if stage_specific_model else None
+    try:
+        while len(all_runs) < repetitions:
+            round_size = max(min_repetitions - len(all_runs), 1) if adaptive else repetitions
+            new_runs = [_new_run_state(rep) for rep in range(len(all_runs), min(len(all_runs) + round_size, repetitions))]
+            run_groups = [new_runs] if stack_repetitions else [[run] for run in new_runs]
+            for runs in run_groups:
+                _run_counting_pass(
+                    current_image_list, runs, cell_counter, target_rbc_count,
+                    batch_size, image_cache, seed, stage_pass, report_progress
+                )
+                repetitions_completed += len(runs)
+            all_runs.extend(new_runs)
+            if not adaptive:
                 break
 
-            # --- 1. Augmentation ---
-            augmented_img = augment_microscopic_image(image_data)
-            if augmented_img is None:
-                
-                continue
-
-            images_processed_this_run += 1 # Count only successfully augmented images
-
-            # --- 2. Prediction - Asexual Parasites ---
-            try:
-                # Use actual model object for prediction
-                parasite_results = asexual_parasite_model.predict(augmented_img, verbose=False)
-                if parasite_results and parasite_results[0].boxes and parasite_results[0].boxes.cls is not None:
-                    # Extract class IDs (convert tensor to list of ints)
-                    detected_classes = parasite_results[0].boxes.cls.int().tolist()
-                    # Count parasites matching the target class ID
-                    parasites_in_image = len(detected_classes)
-                    run_parasite_count += parasites_in_image
-                else:
-                    parasites_in_image = 0
-            except Exception as e:
-                
-                parasites_in_image = 0
-
-            # --- 3. Prediction - Uninfected RBCs ---
-            try:
-                # Use actual model object for prediction
-                rbc_results = rbc_model.predict(augmented_img, verbose=False)
-                if rbc_results and rbc_results[0].boxes and rbc_results[0].boxes.cls is not None:
-                    detected_classes = rbc_results[0].boxes.cls.int().tolist()
-                    rbcs_in_image = detected_classes.count(rbc_class_id)
-                    run_rbc_count += rbcs_in_image
-                else:
-                    rbcs_in_image = 0
-            except Exception as e:
-                rbcs_in_image = 0
-
-        # --- 4. Prediction - Specific Stages (Optional) ---
-        if stage_specific_model:
-            try:
-                stage_results = stage_specific_model.predict([augment_microscopic_image(im)for im in current_image_list[:images_processed_this_run]], verbose=False)
-                if stage_results:
-                    for stage_img_results in stage_results:
-                        detected_classes = stage_img_results.boxes.cls.int().tolist()
-                        # Count occurrences of each relevant stage class ID
-                       
-                        stages_in_image = Counter(detected_classes)
-                        
-                        run_stage_counts_raw.update(stages_in_image)                            
-            except Exception as e:
-                pass
-        
+            for run in new_runs:
+                parasitemia_stats.add(_run_parasitemia(run))
+            if parasitemia_stats.n >= min_repetitions and parasitemia_stats.ci_half_width(confidence) <= ci_tolerance:
+                stopping_reason = "converged"
+                break
+        else:
+            stopping_reason = "max_repetitions"
+        # No more images are needed - lets a streaming source cancel pending downloads
+        current_image_list.close()
+        if stage_pass is not None:
+            stage_pass.finish()
+    finally:
+        current_image_list.close()
+        if stage_executor is not None:
+            stage_executor.shutdown(wait=True)
+    if detection_cache is not None:
+        print(f"Detection cache: {detection_cache.hits} hits, {detection_cache.misses} misses")
+
+    for run in all_runs:
+        rep = run["repetition"]
+        run_parasite_count = run["parasite_count"]
+        run_rbc_count = run["rbc_count"]
+        images_processed_this_run = run["images_processed"]
+        contributing_images = run["contributing_images"]
+        run_stage_counts_raw = run["stage_counts_raw"]
 
         # --- Calculate results for this run ---
         total_rbcs_examined = run_parasite_count + run_rbc_count
@@ -194,6 +737,7 @@ def calculate_parasite_density(
             "stage_counts_named": run_stage_counts_named, # For display
             "stage_counts_raw": dict(run_stage_counts_raw), # For averaging {id: count}
             "images_processed": images_processed_this_run,
+            "contributing_images": contributing_images,
         }
         all_run_results.append(run_result)
         total_images_processed_per_run.append(images_processed_this_run)
@@ -205,6 +749,7 @@ def calculate_parasite_density(
         return None
 
     avg_parasitemia = np.mean([r['parasitemia_percent'] for r in all_run_results])
+    ci_half_width = parasitemia_stats.ci_half_width(confidence) if adaptive else float("inf")
     avg_density = np.mean([r['parasite_density_per_1000_rbc'] for r in all_run_results])
 
     # Average stage counts correctly
@@ -216,10 +761,11 @@ def calculate_parasite_density(
               total_stage_counts_sum.update(run_res.get("stage_counts_named", {}))
 
          # Calculate average for each stage
-         if repetitions > 0:
+         repetitions_run = len(all_run_results)
+         if repetitions_run > 0:
              for stage_id, total_count in total_stage_counts_sum.items():
                    stage_name = stage_class_map.get(stage_id, f"Unknown_{stage_id}")
-                   avg_stage_counts_final[stage_id] = round(total_count / repetitions)
+                   avg_stage_counts_final[stage_id] = round(total_count / repetitions_run)
 
     return {
         "average_parasitemia_percent": avg_parasitemia,
@@ -228,6 +774,9 @@ def calculate_parasite_density(
         "total_images_processed_per_run": total_images_processed_per_run,
         "total_rbcs_counted_per_run": total_rbcs_counted_per_run,
         "all_run_results": all_run_results,
+        "repetitions_run": len(all_run_results),
+        "stopping_reason": stopping_reason,
+        "parasitemia_ci_half_width": ci_half_width if np.isfinite(ci_half_width) else None,
     }
 
 
@@ -4,11 +4,76 @@ import uuid
 import tempfile
 import aiohttp
 import asyncio
-from typing import List
+import jwt
+import hashlib
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Optional
 from datetime import datetime, timedelta
 from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from fastapi import UploadFile
 
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+UPLOAD_URL_EXPIRY_MINUTES = int(os.getenv("UPLOAD_URL_EXPIRY_MINUTES", "30"))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+GCS_BATCH_SIZE = 100  # max calls per GCS batch request
+SWEEP_PAGE_SIZE = int(os.getenv("IMAGE_SWEEP_PAGE_SIZE", "500"))
+
+# Content-addressed layout: image bytes live once under cas/{sha256}{ext}; each task
+# that uses them holds a reference (cas/refs/{key}/{task_id}, mirrored by a marker
+# at tasks/{task_id}/cas/{key} so a task's references can be listed)
+CAS_PREFIX = "cas"
+LOCAL_UPLOAD_ROOT = "uploads"
+_CAS_HASH_PATTERN = re.compile(r"(?:^|/)cas/([0-9a-f]{64})[^/?]*(?:\?|$)")
+
+def cas_content_hash(url_or_path: str) -> Optional[str]:
+    """SHA-256 of an image stored in the content-addressed layout, read from its name"""
+    match = _CAS_HASH_PATTERN.search(url_or_path)
+    return match.group(1) if match else None
+
+def _cas_key(sha256: str, filename: Optional[str]) -> str:
+    file_extension = (os.path.splitext(filename)[1] if filename else '') or '.jpg'
+    return f"{sha256}{file_extension.lower()}"
+
+async def _upload_file_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+    """Read an UploadFile UPLOAD_CHUNK_BYTES at a time"""
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+async def stream_to_file(chunks: AsyncIterator[bytes], file_path: str, max_bytes: int = MAX_UPLOAD_BYTES):
+    """
+    Write an async stream of chunks to `file_path` without holding the body in memory.
+    Hashes while writing and aborts (removing the partial file) as soon as the stream
+    exceeds `max_bytes`. Disk writes run off the event loop.
+    
+    Returns (size_in_bytes, sha256_hexdigest).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, file_path, "wb")
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"Upload exceeds {max_bytes // (1024 * 1024)} MB limit")
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        raise
+    await asyncio.to_thread(f.close)
+    return size, digest.hexdigest()
+
 class GCPStorageService:
     def __init__(self):
         try:
@@ -26,38 +91,182 @@ class GCPStorageService:
         if self.use_local_storage:
             return await self._upload_local(files, task_id)
         
-        urls = []
-        for i, file in enumerate(files):
-            try:
-                file_extension = os.path.splitext(file.filename)[1] if file.filename else '.jpg'
-                unique_filename = f"tasks/{task_id}/image_{i}_{uuid.uuid4().hex[:8]}{file_extension}"
-                
-                blob = self.bucket.blob(unique_filename)
+        # Blocking GCS calls run on worker threads, at most UPLOAD_CONCURRENCY at a time,
+        # so the event loop stays free and /submit takes max-of-uploads, not sum
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        stored_keys = []
+        
+        async def upload_one(file: UploadFile) -> str:
+            async with semaphore:
                 file_content = await file.read()
+                await file.seek(0)
+                key = _cas_key(hashlib.sha256(file_content).hexdigest(), file.filename)
                 
-                # Upload to GCP (private, not public)
-                blob.upload_from_string(
+                # Upload to GCP (private, not public) unless these bytes are already stored
+                blob = await asyncio.to_thread(
+                    self._store_cas_blob,
+                    task_id,
+                    key,
                     file_content,
-                    content_type=file.content_type or 'image/jpeg'
+                    file.content_type or 'image/jpeg'
                 )
+                stored_keys.append(key)
                 
                 # Generate signed URL (valid for 24 hours)
-                signed_url = blob.generate_signed_url(
-                    version="v4",
-                    expiration=datetime.utcnow() + timedelta(hours=24),
-                    method="GET"
-                )
-                
-                urls.append(signed_url)
-                await file.seek(0)
-                
-                
-            except Exception as e:
-                print(f"Failed to upload {file.filename}: {e}")
-                #await self.cleanup_task_images(task_id)
-                raise Exception(f"Upload failed: {str(e)}")
+                return await asyncio.to_thread(self._signed_get_url, blob)
+        
+        results = await asyncio.gather(
+            *(upload_one(file) for file in files),
+            return_exceptions=True
+        )
+        
+        failures = [(file, r) for file, r in zip(files, results) if isinstance(r, Exception)]
+        if failures:
+            for file, error in failures:
+                print(f"Failed to upload {file.filename}: {error}")
+            # Don't leave a half-uploaded task behind
+            for key in stored_keys:
+                await asyncio.to_thread(self._release_cas_ref, task_id, key)
+            raise Exception(f"Upload failed: {str(failures[0][1])}")
         
-        return urls
+        return list(results)
+    
+    def _signed_get_url(self, blob) -> str:
+        return blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.utcnow() + timedelta(hours=24),
+            method="GET"
+        )
+    
+    def _store_cas_blob(self, task_id: str, key: str, content: bytes, content_type: str):
+        """
+        Reference cas/{key} from the task, uploading the bytes only if no task has yet.
+        
+        An existing blob is only touched (metadata patch, if_metageneration_match), which
+        bumps its metageneration so a concurrent _release_cas_ref that saw no references
+        can no longer delete it. A missing blob is created with if_generation_match=0, so
+        two tasks uploading the same new image never overwrite each other.
+        """
+        # Reference first, so a concurrent cleanup never sees the blob unreferenced
+        self._add_cas_ref(task_id, key)
+        try:
+            for _ in range(3):
+                blob = self.bucket.get_blob(f"{CAS_PREFIX}/{key}")
+                try:
+                    if blob is None:
+                        blob = self.bucket.blob(f"{CAS_PREFIX}/{key}")
+                        blob.upload_from_string(content, content_type=content_type, if_generation_match=0)
+                        return blob
+                    blob.metadata = {"last_referenced": datetime.utcnow().isoformat()}
+                    blob.patch(if_metageneration_match=blob.metageneration)
+                    print(f"♻️ Reusing stored image {key}")
+                    return blob
+                except (PreconditionFailed, NotFound):
+                    continue  # created, touched or deleted in between - look again
+            raise Exception(f"Could not store {key}: blob kept changing concurrently")
+        except Exception:
+            # Don't leave a reference to bytes this task never stored
+            self._release_cas_ref(task_id, key)
+            raise
+    
+    def _store_local_cas_file(self, task_id: str, key: str, incoming_path: str) -> str:
+        """Local counterpart of _store_cas_blob: move a fully written file into the store"""
+        file_path = os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, key)
+        self._add_cas_ref(task_id, key)
+        try:
+            if os.path.exists(file_path):
+                os.remove(incoming_path)
+                print(f"♻️ Reusing stored image {key}")
+            else:
+                os.replace(incoming_path, file_path)
+        except Exception:
+            self._release_cas_ref(task_id, key)
+            raise
+        return file_path
+    
+    def _add_cas_ref(self, task_id: str, key: str):
+        if self.use_local_storage:
+            for marker in self._local_ref_markers(task_id, key):
+                os.makedirs(os.path.dirname(marker), exist_ok=True)
+                open(marker, "a").close()
+        else:
+            for marker in self._gcs_ref_markers(task_id, key):
+                self.bucket.blob(marker).upload_from_string(b"")
+    
+    def _release_cas_ref(self, task_id: str, key: str):
+        """Drop the task's reference and delete the stored image once nothing refers to it"""
+        if self.use_local_storage:
+            for marker in self._local_ref_markers(task_id, key):
+                try:
+                    os.remove(marker)
+                except FileNotFoundError:
+                    pass
+            refs_dir = os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, "refs", key)
+            if os.path.isdir(refs_dir) and not os.listdir(refs_dir):
+                os.rmdir(refs_dir)
+            if not os.path.isdir(refs_dir):
+                try:
+                    os.remove(os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, key))
+                except FileNotFoundError:
+                    pass
+        else:
+            self._delete_blobs([self.bucket.blob(marker) for marker in self._gcs_ref_markers(task_id, key)])
+            self._delete_unreferenced_cas_blob(key)
+    
+    def _delete_unreferenced_cas_blob(self, key: str):
+        """
+        Delete cas/{key} if no task references it. The blob's generation and
+        metageneration are read *before* the reference check and required on delete,
+        so a task that references (and touches) it in between keeps it alive.
+        """
+        blob = self.bucket.get_blob(f"{CAS_PREFIX}/{key}")
+        if blob is None or self._has_cas_refs(key):
+            return
+        try:
+            blob.delete(if_generation_match=blob.generation, if_metageneration_match=blob.metageneration)
+        except (PreconditionFailed, NotFound):
+            pass  # re-referenced or already gone
+    
+    def _has_cas_refs(self, key: str) -> bool:
+        return next(iter(self.bucket.list_blobs(prefix=f"{CAS_PREFIX}/refs/{key}/", max_results=1)), None) is not None
+    
+    def _gcs_ref_markers(self, task_id: str, key: str) -> List[str]:
+        return [f"{CAS_PREFIX}/refs/{key}/{task_id}", f"tasks/{task_id}/{CAS_PREFIX}/{key}"]
+    
+    def _local_ref_markers(self, task_id: str, key: str) -> List[str]:
+        return [
+            os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, "refs", key, task_id),
+            os.path.join(LOCAL_UPLOAD_ROOT, task_id, CAS_PREFIX, key),
+        ]
+    
+    def _delete_blobs(self, blobs):
+        """
+        Delete blobs GCS_BATCH_SIZE at a time in batch requests. Already-missing
+        blobs (404) are ignored; any other failure raises once every chunk has
+        been tried, so the calling task can retry.
+        """
+        blobs = list(blobs)
+        failed = []
+        for start in range(0, len(blobs), GCS_BATCH_SIZE):
+            chunk = blobs[start:start + GCS_BATCH_SIZE]
+            try:
+                # Deletes issued while the batch is current are deferred into it;
+                # finish() sends them and returns one response per delete, in order
+                batch = self.client.batch(raise_exception=False)
+                self.client._push_batch(batch)
+                try:
+                    for blob in chunk:
+                        blob.delete()
+                finally:
+                    self.client._pop_batch()
+                responses = batch.finish(raise_exception=False)
+                for blob, response in zip(chunk, responses):
+                    if response.status_code != 404 and not 200 <= response.status_code < 300:
+                        failed.append(f"{blob.name} (HTTP {response.status_code})")
+            except Exception as e:
+                failed.extend(f"{blob.name} ({e})" for blob in chunk)
+        if failed:
+            raise Exception(f"Failed to delete {len(failed)} of {len(blobs)} blobs, e.g. {failed[0]}")
     
     async def download_image(self, url: str) -> bytes:
         """Download image from signed URL or local path"""
@@ -78,25 +287,137 @@ class GCPStorageService:
             print(f"Failed to download image from {url}: {e}")
             raise
     
-    async def _upload_local(self, files: List[UploadFile], task_id: str) -> List[str]:
-        """Fallback: Save to local storage and return file paths"""
+    async def create_upload_urls(self, task_id: str, files: List[dict], resumable: bool = False) -> List[dict]:
+        """
+        Direct-upload step 1: issue one upload target per file under tasks/{task_id}/
+        so the client sends image bytes straight to the bucket instead of through the API.
+        
+        `files` items are {"filename": ..., "content_type": ...}. Returns, per file, the
+        object name plus the URL, method and headers the client must use. With
+        `resumable` a GCS resumable session URL is returned (PUT, can be resumed);
+        otherwise a V4 signed PUT URL. The local fallback returns a token-protected
+        URL on this API (PUT /local-upload/...).
+        """
+        targets = []
+        for i, file in enumerate(files):
+            file_extension = os.path.splitext(file.get("filename") or "")[1] or '.jpg'
+            filename = f"image_{i}_{uuid.uuid4().hex[:8]}{file_extension}"
+            content_type = file.get("content_type") or 'image/jpeg'
+            targets.append((filename, content_type))
+        
+        if self.use_local_storage:
+            return [{
+                "object_name": os.path.join(f"uploads/{task_id}", filename),
+                "upload_url": f"/local-upload/{task_id}/{filename}?token={self._local_upload_token(task_id, filename)}",
+                "method": "PUT",
+                "headers": {"Content-Type": content_type},
+            } for filename, content_type in targets]
+        
+        expiration = datetime.utcnow() + timedelta(minutes=UPLOAD_URL_EXPIRY_MINUTES)
+        
+        def upload_target(filename: str, content_type: str) -> dict:
+            blob = self.bucket.blob(f"tasks/{task_id}/{filename}")
+            if resumable:
+                url = blob.create_resumable_upload_session(content_type=content_type)
+            else:
+                url = blob.generate_signed_url(
+                    version="v4",
+                    expiration=expiration,
+                    method="PUT",
+                    content_type=content_type
+                )
+            return {
+                "object_name": blob.name,
+                "upload_url": url,
+                "method": "PUT",
+                "headers": {"Content-Type": content_type},
+            }
+        
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        
+        async def bounded(filename: str, content_type: str) -> dict:
+            async with semaphore:
+                return await asyncio.to_thread(upload_target, filename, content_type)
+        
+        return list(await asyncio.gather(*(bounded(f, c) for f, c in targets)))
+    
+    async def verify_uploads(self, task_id: str, object_names: List[str]) -> List[str]:
+        """
+        Direct-upload step 2: check every expected object exists and is non-empty,
+        then return what process_malaria_images expects (signed GET URLs, or local paths).
+        Raises FileNotFoundError listing the missing objects.
+        """
+        if self.use_local_storage:
+            missing = [path for path in object_names if not os.path.isfile(path) or os.path.getsize(path) == 0]
+            if missing:
+                raise FileNotFoundError(f"Missing uploads: {missing}")
+            return list(object_names)
+        
+        def check(object_name: str) -> Optional[str]:
+            blob = self.bucket.get_blob(object_name)
+            if blob is None or not blob.size:
+                return None
+            return self._signed_get_url(blob)
+        
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        
+        async def bounded(object_name: str) -> Optional[str]:
+            async with semaphore:
+                return await asyncio.to_thread(check, object_name)
+        
+        urls = await asyncio.gather(*(bounded(name) for name in object_names))
+        missing = [name for name, url in zip(object_names, urls) if url is None]
+        if missing:
+            raise FileNotFoundError(f"Missing uploads: {missing}")
+        return list(urls)
+    
+    def _local_upload_token(self, task_id: str, filename: str) -> str:
+        return jwt.encode(
+            {
+                "task_id": task_id,
+                "filename": filename,
+                "exp": datetime.utcnow() + timedelta(minutes=UPLOAD_URL_EXPIRY_MINUTES),
+            },
+            os.getenv("JWT_SECRET_KEY"),
+            algorithm="HS256"
+        )
+    
+    def verify_local_upload_token(self, token: str, task_id: str, filename: str) -> bool:
+        try:
+            payload = jwt.decode(token, os.getenv("JWT_SECRET_KEY"), algorithms=["HS256"])
+        except jwt.PyJWTError:
+            return False
+        return payload.get("task_id") == task_id and payload.get("filename") == filename
+    
+    async def save_local_upload(self, task_id: str, filename: str, chunks: AsyncIterator[bytes]) -> str:
+        """Local stand-in for the bucket: write a PUT body to uploads/{task_id}/{filename}"""
+        if os.path.basename(filename) != filename:
+            raise ValueError("Invalid filename")
         upload_dir = f"uploads/{task_id}"
         os.makedirs(upload_dir, exist_ok=True)
+        file_path = os.path.join(upload_dir, filename)
+        
+        await stream_to_file(chunks, file_path)
+        return file_path
+    
+    async def _upload_local(self, files: List[UploadFile], task_id: str) -> List[str]:
+        """Fallback: Save to the local content-addressed store and return file paths"""
+        cas_dir = os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX)
+        os.makedirs(cas_dir, exist_ok=True)
         
         file_paths = []
-        for i, file in enumerate(files):
+        for file in files:
             try:
-                file_extension = os.path.splitext(file.filename)[1] if file.filename else '.jpg'
-                filename = f"image_{i}_{uuid.uuid4().hex[:8]}{file_extension}"
-                file_path = os.path.join(upload_dir, filename)
+                # Chunked so a large submit never sits in API memory in full; the name
+                # is only known once the content hash is
+                incoming_path = os.path.join(cas_dir, f".incoming_{uuid.uuid4().hex}")
+                _, sha256 = await stream_to_file(_upload_file_chunks(file), incoming_path)
+                await file.seek(0)
                 
-                content = await file.read()
-                with open(file_path, "wb") as f:
-                    f.write(content)
+                key = _cas_key(sha256, file.filename)
+                file_path = await asyncio.to_thread(self._store_local_cas_file, task_id, key, incoming_path)
                 
                 file_paths.append(file_path)
-                await file.seek(0)
-                
                 
             except Exception as e:
                 print(f"Failed to save {file.filename}: {e}")
@@ -105,48 +426,95 @@ class GCPStorageService:
         return file_paths
     
     async def cleanup_task_images(self, task_id: str):
-        """Clean up images (GCP or local)"""
+        """Clean up images (GCP or local); shared images go only when no task references them"""
         try:
-            if self.use_local_storage:
-                import shutil
-                upload_dir = f"uploads/{task_id}"
-                if os.path.exists(upload_dir):
-                    shutil.rmtree(upload_dir)
-            else:
-                # GCP cleanup
-                blobs = self.bucket.list_blobs(prefix=f"tasks/{task_id}/")
-                for blob in blobs:
-                    blob.delete()
+            await asyncio.to_thread(self.purge_task_images, task_id)
         except Exception as e:
             print(f"Failed to cleanup images for task {task_id}: {e}")
     
+    def purge_task_images(self, task_id: str):
+        """
+        Blocking body of cleanup_task_images, run by the delete_task_images
+        background task so request handlers don't wait on deletes. Raises on failure.
+        """
+        if self.use_local_storage:
+            upload_dir = os.path.join(LOCAL_UPLOAD_ROOT, task_id)
+            marker_dir = os.path.join(upload_dir, CAS_PREFIX)
+            if os.path.isdir(marker_dir):
+                for key in os.listdir(marker_dir):
+                    self._release_cas_ref(task_id, key)
+            if os.path.exists(upload_dir):
+                shutil.rmtree(upload_dir)
+        else:
+            # GCP cleanup
+            self._cleanup_gcs_task(task_id)
+    
+    def _cleanup_gcs_task(self, task_id: str):
+        marker_prefix = f"tasks/{task_id}/{CAS_PREFIX}/"
+        keys = []
+        blobs = []
+        for blob in self.bucket.list_blobs(prefix=f"tasks/{task_id}/", page_size=SWEEP_PAGE_SIZE):
+            if blob.name.startswith(marker_prefix):
+                keys.append(blob.name[len(marker_prefix):])
+            # Reference markers and direct uploads both live under the task prefix
+            blobs.append(blob)
+        
+        # Task blobs plus the other reference marker per stored image, in batch requests
+        blobs.extend(self.bucket.blob(f"{CAS_PREFIX}/refs/{key}/{task_id}") for key in keys)
+        self._delete_blobs(blobs)
+        
+        if keys:
+            # Conditional deletes (see _delete_unreferenced_cas_blob), run concurrently
+            with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+                list(executor.map(self._delete_unreferenced_cas_blob, keys))
+    
     async def cleanup_old_images(self, days_old: int = 7):
         """Clean up images older than specified days"""
         try:
-            if self.use_local_storage:
-                # Local cleanup
-                cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-                upload_base = "uploads"
-                if os.path.exists(upload_base):
-                    for task_dir in os.listdir(upload_base):
-                        task_path = os.path.join(upload_base, task_dir)
-                        if os.path.isdir(task_path):
-                            # Check directory creation time
-                            dir_time = datetime.fromtimestamp(os.path.getctime(task_path))
-                            if dir_time < cutoff_date:
-                                import shutil
-                                shutil.rmtree(task_path)
-            else:
-                # GCP cleanup
-                cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-                blobs = self.bucket.list_blobs(prefix="tasks/")
-                
-                for blob in blobs:
-                    if blob.time_created < cutoff_date.replace(tzinfo=blob.time_created.tzinfo):
-                        blob.delete()
-                
+            await asyncio.to_thread(self.sweep_old_images, days_old)
         except Exception as e:
             print(f"Failed to cleanup old images: {e}")
+    
+    def sweep_old_images(self, days_old: int = 7) -> int:
+        """
+        Purge every task whose images are older than `days_old` days; returns how many.
+        On GCS only the task prefixes are listed (delimiter listing, page by page)
+        and one blob per task is fetched to date it, instead of listing every image.
+        """
+        cutoff_date = datetime.utcnow() - timedelta(days=days_old)
+        purged = 0
+        if self.use_local_storage:
+            # Local cleanup
+            if os.path.exists(LOCAL_UPLOAD_ROOT):
+                for task_dir in os.listdir(LOCAL_UPLOAD_ROOT):
+                    task_path = os.path.join(LOCAL_UPLOAD_ROOT, task_dir)
+                    # The shared store is emptied through task references, never by age
+                    if task_dir != CAS_PREFIX and os.path.isdir(task_path):
+                        # Check directory creation time
+                        dir_time = datetime.fromtimestamp(os.path.getctime(task_path))
+                        if dir_time < cutoff_date:
+                            self.purge_task_images(task_dir)
+                            purged += 1
+            return purged
+        
+        # GCP cleanup
+        def is_old(task_prefix: str) -> bool:
+            blob = next(iter(self.bucket.list_blobs(prefix=task_prefix, max_results=1)), None)
+            return blob is not None and blob.time_created < cutoff_date.replace(tzinfo=blob.time_created.tzinfo)
+        
+        iterator = self.bucket.list_blobs(prefix="tasks/", delimiter="/", page_size=SWEEP_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            for page in iterator.pages:
+                task_prefixes = list(page.prefixes)
+                for task_prefix, old in zip(task_prefixes, executor.map(is_old, task_prefixes)):
+                    if old:
+                        # A failed purge is picked up again by the next sweep
+                        try:
+                            self.purge_task_images(task_prefix.split("/")[1])
+                            purged += 1
+                        except Exception as e:
+                            print(f"⚠️ Failed to purge {task_prefix}: {e}")
+        return purged
 
 # Global instance
 gcp_storage = GCPStorageService()
\ No newline at end of file
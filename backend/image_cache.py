@@ -0,0 +1,71 @@
+import io
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+DEFAULT_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+
+def image_cache_key(image_path_or_bytes):
+    """Cache key for a file path or raw image bytes"""
+    if isinstance(image_path_or_bytes, str):
+        return ("path", os.path.abspath(image_path_or_bytes))
+    return ("sha256", hashlib.sha256(image_path_or_bytes).hexdigest())
+
+
+class DecodedImageCache:
+    """
+    Per-task LRU cache of decoded RGB images, bounded by total array bytes.
+
+    Cached arrays are marked read-only so every consumer shares the same
+    buffer; augmentation always writes into new arrays, never into the cached one.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _decode(self, image_path_or_bytes):
+        if isinstance(image_path_or_bytes, str):
+            img = Image.open(image_path_or_bytes)
+        else:
+            img = Image.open(io.BytesIO(image_path_or_bytes))
+        array = np.asarray(img.convert("RGB"))
+        array.flags.writeable = False
+        return array
+
+    def get(self, image_path_or_bytes):
+        """Return the decoded (read-only) RGB array, decoding on a miss"""
+        key = image_cache_key(image_path_or_bytes)
+        array = self._entries.get(key)
+        if array is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return array
+
+        self.misses += 1
+        array = self._decode(image_path_or_bytes)
+        self._put(key, array)
+        return array
+
+    def _put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            # Larger than the whole budget - hand it out without caching
+            return
+        while self._entries and self.current_bytes + array.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+        self._entries[key] = array
+        self.current_bytes += array.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
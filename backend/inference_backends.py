@@ -0,0 +1,144 @@
+import os
+import json
+import fcntl
+from ultralytics import YOLO
+
+# INFERENCE_BACKEND values -> ultralytics export format
+EXPORT_FORMATS = {
+    "onnx": "onnx",
+    "openvino": "openvino",
+}
+SUPPORTED_BACKENDS = ("pytorch",) + tuple(EXPORT_FORMATS)
+SUPPORTED_PRECISIONS = ("fp32", "int8")
+
+EXPORT_IMAGE_SIZE = int(os.getenv("EXPORT_IMAGE_SIZE", "640"))
+
+
+def get_inference_backend():
+    backend = os.getenv("INFERENCE_BACKEND", "pytorch").lower()
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f"INFERENCE_BACKEND must be one of {SUPPORTED_BACKENDS}, got '{backend}'")
+    return backend
+
+
+def get_inference_precision():
+    precision = os.getenv("INFERENCE_PRECISION", "fp32").lower()
+    if precision not in SUPPORTED_PRECISIONS:
+        raise ValueError(f"INFERENCE_PRECISION must be one of {SUPPORTED_PRECISIONS}, got '{precision}'")
+    return precision
+
+
+def exported_artifact_path(weights_path, backend):
+    """Where ultralytics writes the exported model (next to the .pt weights)"""
+    stem, _ = os.path.splitext(weights_path)
+    if backend == "onnx":
+        return f"{stem}.onnx"
+    if backend == "openvino":
+        return f"{stem}_openvino_model"
+    return weights_path
+
+
+def _export_manifest_path(weights_path, backend):
+    stem, _ = os.path.splitext(weights_path)
+    return f"{stem}.{backend}.export.json"
+
+
+def _export_lock_path(weights_path, backend):
+    stem, _ = os.path.splitext(weights_path)
+    return f"{stem}.{backend}.lock"
+
+
+def _write_manifest(weights_path, backend, manifest):
+    """Write-then-rename so a reader never sees a partial manifest"""
+    path = _export_manifest_path(weights_path, backend)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _read_manifest(weights_path, backend):
+    try:
+        with open(_export_manifest_path(weights_path, backend)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def ensure_exported(weights_path, backend, weights_sha256, **export_kwargs):
+    """
+    Returns the path of the exported artifact for `backend`, exporting it first
+    if it is missing or was produced from different weights / export settings.
+
+    A small manifest next to the weights records which weights hash and
+    settings the cached artifact came from. Check and export run under an
+    exclusive file lock, so the prefork children starting together export once
+    and never load a half-written artifact.
+    """
+    if backend == "pytorch":
+        return weights_path
+
+    artifact = exported_artifact_path(weights_path, backend)
+    settings = {"imgsz": EXPORT_IMAGE_SIZE, "dynamic": True, **export_kwargs}
+    expected = {"weights_sha256": weights_sha256, "format": EXPORT_FORMATS[backend], "settings": settings}
+    with open(_export_lock_path(weights_path, backend), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another process may have finished the export while we waited
+            if os.path.exists(artifact) and _read_manifest(weights_path, backend) == expected:
+                return artifact
+
+            print(f"🔧 Exporting {weights_path} to {backend} ...")
+            # dynamic axes so batched predicts keep working
+            exported = YOLO(weights_path).export(format=EXPORT_FORMATS[backend], **settings)
+            artifact = str(exported) if exported else artifact
+            _write_manifest(weights_path, backend, expected)
+            print(f"✅ Exported {backend} model to {artifact}")
+            return artifact
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def int8_artifact_path(weights_path):
+    """Quantized ONNX model produced by quantization.py"""
+    stem, _ = os.path.splitext(weights_path)
+    return f"{stem}.int8.onnx"
+
+
+def int8_guard_path():
+    """Accuracy-guard report written by quantization.py"""
+    default_dir = os.path.dirname(os.getenv("ASEXUAL_MODEL_PATH", "")) or "."
+    return os.getenv("INT8_GUARD_PATH", os.path.join(default_dir, "int8_guard.json"))
+
+
+def read_int8_guard():
+    try:
+        with open(int8_guard_path()) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def int8_activation_allowed(name, weights_path, weights_sha256):
+    """
+    INT8 weights may only be used if the last accuracy-guard run passed for
+    exactly these FP32 weights and the quantized artifact is on disk.
+    """
+    guard = read_int8_guard()
+    return (
+        guard.get("passed") is True
+        and guard.get("weights", {}).get(name) == weights_sha256
+        and os.path.exists(int8_artifact_path(weights_path))
+    )
+
+
+def load_model(weights_path, backend, weights_sha256, precision="fp32", **export_kwargs):
+    """Load a detector for `backend`; exported models keep the YOLO predict API and result schema"""
+    if precision == "int8":
+        if backend != "onnx":
+            raise ValueError("INT8 models are only available with INFERENCE_BACKEND=onnx")
+        return YOLO(int8_artifact_path(weights_path), task="detect")
+    if backend == "pytorch":
+        return YOLO(weights_path)
+    artifact = ensure_exported(weights_path, backend, weights_sha256, **export_kwargs)
+    return YOLO(artifact, task="detect")
@@ -3,7 +3,8 @@ import json
 import sys
 from typing import List
 from database import Task
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import nltk
 from nltk.corpus import stopwords
 
@@ -125,7 +126,7 @@ class LlamaChatService:
         
         return "\n".join(context_parts)
 
-    def update_chat_history(self, task: Task, user_msg: str, ai_msg: str, db: Session):
+    async def update_chat_history(self, task: Task, user_msg: str, ai_msg: str, db: AsyncSession):
         """Update chat history - FULL HISTORY ONLY"""
         try:
             # Get existing history
@@ -140,12 +141,12 @@ class LlamaChatService:
             
             # Save updated history
             task.last_chat_history = json.dumps(history)
-            db.commit()
+            await db.commit()
             
         except Exception as e:
             print(f"Error updating chat history: {e}")
 
-    async def generate_comprehensive_report(self, task_id: str, user_id: str, db: Session) -> str:
+    async def generate_comprehensive_report(self, task_id: str, user_id: str, db: AsyncSession) -> str:
         """Generate comprehensive medical report using Llama agent's generate_report() method"""
         if not MalariaResearchAgent:
             return "Llama service not available. Please check AI agent configuration."
@@ -153,7 +154,7 @@ class LlamaChatService:
         try:
             print(f"Generating report for task {task_id}")
             
-            task = db.query(Task).filter(Task.id == task_id, Task.user_id == user_id).first()
+            task = (await db.execute(select(Task).where(Task.id == task_id, Task.user_id == user_id))).scalar_one_or_none()
             if not task:
                 raise Exception("Task not found")
             if not task.result:
@@ -181,13 +182,13 @@ class LlamaChatService:
             print(error_msg)
             return f"{error_msg}. Please use the chat feature for analysis."
 
-    async def chat(self, task_id: str, user_id: str, user_message: str, db: Session) -> str:
+    async def chat(self, task_id: str, user_id: str, user_message: str, db: AsyncSession) -> str:
         """Main chat function using Llama agent with full history context"""
         if not MalariaResearchAgent:
             return "Llama service not available. Please check AI agent configuration."
             
         try:
-            task = db.query(Task).filter(Task.id == task_id, Task.user_id == user_id).first()
+            task = (await db.execute(select(Task).where(Task.id == task_id, Task.user_id == user_id))).scalar_one_or_none()
             if not task:
                 raise Exception("Task not found")
             if not task.result:
@@ -222,7 +223,7 @@ class LlamaChatService:
             print(f"Agent response received: {len(response)} chars")
             
             # ✅ SIMPLIFIED: Update chat history (no TLDRs)
-            self.update_chat_history(task, user_message, response, db)
+            await self.update_chat_history(task, user_message, response, db)
             
             return response
             
@@ -4,21 +4,25 @@ import json
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header, Response, Cookie, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header, Response, Cookie, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
+import base64
+import asyncio
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 from ultralytics import YOLO
 from functions import calculate_parasite_density
 from gcp_storage import gcp_storage
 from celery_app import celery_app
-from tasks import process_malaria_images
-from database import SessionLocal, User, Task, get_db
+from tasks import process_malaria_images, delete_task_images
+from database import User, Task, AsyncSessionLocal, get_async_db, task_page_query
 from llama_service import llama_service
+from task_events import publish_task_event, subscribe_task_events, task_event_stream
 
 
 # Auth
@@ -57,20 +61,27 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)):
+    return await user_from_token(credentials.credentials, db)
+
+async def user_from_token(token: str, db: AsyncSession):
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+async def get_user_task(db: AsyncSession, task_id: str, user_id: str) -> Optional[Task]:
+    result = await db.execute(select(Task).where(Task.id == task_id, Task.user_id == user_id))
+    return result.scalar_one_or_none()
+
 # Auth endpoints
 class UserRegister(BaseModel):
     username: str
@@ -78,13 +89,13 @@ class UserRegister(BaseModel):
     password: str
 
 @app.post("/register")
-async def register(user: UserRegister, db: Session = Depends(get_db)):
+async def register(user: UserRegister, db: AsyncSession = Depends(get_async_db)):
     # Check if user exists
-    existing_user = db.query(User).filter(User.username == user.username).first()
+    existing_user = (await db.execute(select(User).where(User.username == user.username))).scalar_one_or_none()
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    existing_email = db.query(User).filter(User.email == user.email).first()  # Change from email to user.email
+    existing_email = (await db.execute(select(User).where(User.email == user.email))).scalar_one_or_none()  # Change from email to user.email
     if existing_email:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -94,7 +105,7 @@ async def register(user: UserRegister, db: Session = Depends(get_db)):
     new_user = User(id=user_id, username=user.username, email=user.email, hashed_password=hashed_password)  # Change to user.xxx
     
     db.add(new_user)
-    db.commit()
+    await db.commit()
     
     # Create token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -109,10 +120,10 @@ class UserLogin(BaseModel):
     password: str
 
 @app.post("/login")
-async def login(login_data: UserLogin, db: Session = Depends(get_db)):
+async def login(login_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
     # Rest of your login code stays the same
     # Find user
-    user = db.query(User).filter(User.username == login_data.username).first()
+    user = (await db.execute(select(User).where(User.username == login_data.username))).scalar_one_or_none()
     if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
         
@@ -146,7 +157,7 @@ async def submit_images(files: List[UploadFile] = File(...),
                         sex: str = Form(None),  # ✅ ADD: Sex parameter
                         date: str = Form(None),
                         current_user: User = Depends(get_current_user),
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_async_db)):
     if not files:
         raise HTTPException(400, "No files uploaded")
 
@@ -168,10 +179,10 @@ async def submit_images(files: List[UploadFile] = File(...),
             image_urls=json.dumps(image_urls)
         )
         db.add(new_task)
-        db.commit()
+        await db.commit()
 
         # Queue task with URLs instead of file paths
-        process_malaria_images.delay(task_id, image_urls)
+        await asyncio.to_thread(process_malaria_images.delay, task_id, image_urls)
         
         return {
             "task_id": task_id, 
@@ -186,52 +197,152 @@ async def submit_images(files: List[UploadFile] = File(...),
         }
         
     except Exception as e:
-        await gcp_storage.cleanup_task_images(task_id)
+        await asyncio.to_thread(delete_task_images.delay, task_id)
         raise HTTPException(500, f"Upload failed: {str(e)}")
 
-@app.get("/tasks")
-async def list_tasks(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Get all tasks for current user with automatic cleanup"""
+class UploadFileInfo(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+
+class SubmitInit(BaseModel):
+    files: List[UploadFileInfo]
+    patientName: Optional[str] = None
+    tel: Optional[str] = None
+    sex: Optional[str] = None
+    date: Optional[str] = None
+    resumable: bool = False
+
+@app.post("/submit/init")
+async def init_submission(submission: SubmitInit,
+                          current_user: User = Depends(get_current_user),
+                          db: AsyncSession = Depends(get_async_db)):
+    """Create the task and hand back upload URLs; image bytes go straight to the bucket"""
+    if not submission.files:
+        raise HTTPException(400, "No files to upload")
+
+    task_id = str(uuid.uuid4())
+    
     try:
-        # Step 1: Cleanup stuck/orphaned tasks (timeout-based)
-        from tasks import cleanup_orphaned_tasks
-        cleanup_result = cleanup_orphaned_tasks()
+        uploads = await gcp_storage.create_upload_urls(
+            task_id,
+            [file.dict() for file in submission.files],
+            resumable=submission.resumable
+        )
         
-        # Step 2: Delete tasks older than 24 hours
-        forty_two_hours_ago = datetime.utcnow() - timedelta(hours=42)
+        new_task = Task(
+            id=task_id,
+            user_id=current_user.id,
+            status="UPLOADING",
+            patient_name=submission.patientName,
+            phone_number=submission.tel,
+            sex=submission.sex,
+            date=submission.date,
+            # Object names until finalize swaps in the download URLs
+            image_urls=json.dumps([upload["object_name"] for upload in uploads])
+        )
+        db.add(new_task)
+        await db.commit()
         
-        old_tasks = db.query(Task).filter(
-            Task.user_id == current_user.id,
-            Task.created_at < forty_two_hours_ago
-        ).all()
+        return {"task_id": task_id, "status": "UPLOADING", "uploads": uploads}
         
-        old_task_count = len(old_tasks)
-        if old_task_count > 0:
-            for task in old_tasks:
-                db.delete(task)
-            db.commit()
+    except Exception as e:
+        raise HTTPException(500, f"Upload initialisation failed: {str(e)}")
+
+@app.post("/submit/{task_id}/finalize")
+async def finalize_submission(task_id: str,
+                              current_user: User = Depends(get_current_user),
+                              db: AsyncSession = Depends(get_async_db)):
+    """Check every direct upload landed, then queue the task"""
+    task = await get_user_task(db, task_id, current_user.id)
+    if not task:
+        raise HTTPException(404, "Task not found")
+    if task.status != "UPLOADING":
+        raise HTTPException(400, f"Cannot finalize task with status: {task.status}")
+    
+    try:
+        image_urls = await gcp_storage.verify_uploads(task_id, json.loads(task.image_urls))
+    except FileNotFoundError as e:
+        raise HTTPException(400, str(e))
+    
+    task.status = "PROCESSING"
+    task.image_urls = json.dumps(image_urls)
+    await db.commit()
+    await asyncio.to_thread(publish_task_event, task_id, {"status": "PROCESSING", "summary": None})
+    
+    await asyncio.to_thread(process_malaria_images.delay, task_id, image_urls)
+    
+    return {
+        "task_id": task_id,
+        "status": "PENDING",
+        "images_uploaded": len(image_urls),
+        "patient_info": {
+            "name": task.patient_name,
+            "phone": task.phone_number,
+            "sex": task.sex,
+            "date": task.date
+        }
+    }
+
+@app.put("/local-upload/{task_id}/{filename}")
+async def local_upload(task_id: str, filename: str, token: str, request: Request):
+    """Stand-in for the signed bucket URL when running with local storage"""
+    if not gcp_storage.verify_local_upload_token(token, task_id, filename):
+        raise HTTPException(403, "Invalid or expired upload token")
+    try:
+        await gcp_storage.save_local_upload(task_id, filename, request.stream())
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"status": "uploaded"}
 
+TASKS_PAGE_SIZE = int(os.getenv("TASKS_PAGE_SIZE", "50"))
+TASKS_MAX_PAGE_SIZE = 200
+
+def encode_task_cursor(created_at: datetime, task_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{task_id}".encode()).decode()
+
+def decode_task_cursor(cursor: str):
+    try:
+        created_at, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), task_id
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+@app.get("/tasks")
+async def list_tasks(response: Response,
+                     limit: int = TASKS_PAGE_SIZE,
+                     cursor: Optional[str] = None,
+                     current_user: User = Depends(get_current_user),
+                     db: AsyncSession = Depends(get_async_db)):
+    """
+    One page of the current user's tasks, newest first (stuck/expired task cleanup
+    runs on the Celery beat schedule). Only summary columns are read, through the
+    (user_id, created_at) index; full results come from /result/{task_id}.
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    limit = max(1, min(limit, TASKS_MAX_PAGE_SIZE))
+    try:
+        query = task_page_query(current_user.id, limit, decode_task_cursor(cursor) if cursor else None)
         
-        # Step 3: Get remaining tasks
-        tasks = db.query(Task).filter(Task.user_id == current_user.id).order_by(Task.created_at.desc()).all()
+        # One extra row tells us whether there is a next page
+        tasks = (await db.execute(query)).all()
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            response.headers["X-Next-Cursor"] = encode_task_cursor(tasks[-1].created_at, tasks[-1].id)
         
         task_dict = {}
         for task in tasks:
-            try:
-                result = json.loads(task.result) if task.result else {}
-            except:
-                result = {"error": "Invalid result data"}
-            
             task_dict[task.id] = {
                 "status": task.status,
                 "created_at": task.created_at.isoformat(),
                 "patient_name": task.patient_name,
                 "date": task.date,
-                "result": result
+                "summary": task.summary or {}
             }
         
         return task_dict
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in list_tasks: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch tasks")
@@ -241,27 +352,27 @@ async def list_tasks(current_user: User = Depends(get_current_user), db: Session
 async def delete_task(
     task_id: str, 
     current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a task and cleanup associated resources"""
     try:
         # Find the task
-        task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+        task = await get_user_task(db, task_id, current_user.id)
         if not task:
             raise HTTPException(404, "Task not found")
         
-        # Cleanup GCP images if they exist
+        # Cleanup GCP images if they exist (in the background)
         if task.image_urls:
             try:
-                await gcp_storage.cleanup_task_images(task_id)
-                print(f"✅ Cleaned up GCP images for task {task_id}")
+                await asyncio.to_thread(delete_task_images.delay, task_id)
+                print(f"✅ Queued GCP image cleanup for task {task_id}")
             except Exception as gcp_error:
                 print(f"⚠️ Failed to cleanup GCP images: {gcp_error}")
                 # Don't fail deletion if cleanup fails
         
         # Delete from database
-        db.delete(task)
-        db.commit()
+        await db.delete(task)
+        await db.commit()
         
         return {"message": f"Task {task_id} deleted successfully"}
         
@@ -271,8 +382,8 @@ async def delete_task(
         raise HTTPException(500, f"Failed to delete task: {str(e)}")
     
 @app.get("/result/{task_id}")
-async def get_result(task_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+async def get_result(task_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    task = await get_user_task(db, task_id, current_user.id)
     if not task:
         raise HTTPException(404, "Task ID not found")
     
@@ -287,25 +398,25 @@ async def get_result(task_id: str, current_user: User = Depends(get_current_user
                 
                 # Save report to database
                 task.ai_report = ai_report
-                db.commit()
+                await db.commit()
                 print(f"✅ AI report generated and cached for task {task_id}")
                 
             except Exception as e:
                 print(f"⚠️ Failed to generate AI report: {e}")
                 # Set a fallback message
                 task.ai_report = "AI report generation failed. Please use the chat feature for detailed analysis."
-                db.commit()
+                await db.commit()
         
         # Delete GCP images on first successful result access
         if task.image_urls:
             try:
-                print(f"Cleaning up GCP images for task {task_id}...")
-                await gcp_storage.cleanup_task_images(task_id)
+                print(f"Queueing GCP image cleanup for task {task_id}...")
+                await asyncio.to_thread(delete_task_images.delay, task_id)
                 
-                # Clear image_urls to indicate cleanup is done
+                # Clear image_urls to indicate cleanup is handled
                 task.image_urls = None
-                db.commit()
-                print(f"✅ GCP images cleaned up for task {task_id}")
+                await db.commit()
+                print(f"✅ GCP image cleanup queued for task {task_id}")
                 
             except Exception as gcp_error:
                 print(f"⚠️ Failed to cleanup GCP images for task {task_id}: {gcp_error}")
@@ -322,12 +433,52 @@ async def get_result(task_id: str, current_user: User = Depends(get_current_user
         "ai_report": task.ai_report
     }
 
+@app.get("/progress/{task_id}")
+async def get_progress(task_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Status and latest inference progress only - cheap enough to poll"""
+    row = (await db.execute(
+        select(Task.status, Task.progress).where(Task.id == task_id, Task.user_id == current_user.id)
+    )).first()
+    if not row:
+        raise HTTPException(404, "Task ID not found")
+    return {"status": row.status, "progress": row.progress}
+
+@app.get("/events/{task_id}")
+async def task_events(task_id: str, token: str):
+    """
+    Server-Sent Events for one task (status changes and progress), pushed from
+    the worker over Redis pub/sub - subscribe once instead of polling.
+    EventSource can't send headers, so the access token comes as ?token=.
+    """
+    # Own short session: no DB connection is held while the stream is open
+    async with AsyncSessionLocal() as db:
+        current_user = await user_from_token(token, db)
+        # Subscribe before reading the current state so no transition is missed in between
+        pubsub = await subscribe_task_events(task_id)
+        try:
+            row = (await db.execute(
+                select(Task.status, Task.summary, Task.progress).where(Task.id == task_id, Task.user_id == current_user.id)
+            )).first()
+        except Exception:
+            await pubsub.aclose()
+            raise
+    if not row:
+        await pubsub.aclose()
+        raise HTTPException(404, "Task ID not found")
+    
+    initial_event = {"status": row.status, "summary": row.summary, "progress": row.progress}
+    return StreamingResponse(
+        task_event_stream(pubsub, initial_event),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/retry/{task_id}")
-async def retry_task(task_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def retry_task(task_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Retry a failed task using stored image URLs"""
     try:
         # Find the failed task
-        task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+        task = await get_user_task(db, task_id, current_user.id)
         if not task:
             raise HTTPException(404, "Task not found")
         
@@ -343,11 +494,13 @@ async def retry_task(task_id: str, current_user: User = Depends(get_current_user
         # Reset task status to PENDING
         task.status = "PENDING"
         task.result = json.dumps({"status": "retrying"})
-        db.commit()
+        task.summary = None
+        await db.commit()
+        await asyncio.to_thread(publish_task_event, task_id, {"status": "PENDING", "summary": None})
         
         # Queue the task again with same URLs
         from tasks import process_malaria_images
-        process_malaria_images.delay(task_id, image_urls)
+        await asyncio.to_thread(process_malaria_images.delay, task_id, image_urls)
         
         
         return {
@@ -365,7 +518,7 @@ async def chat_with_task(
     task_id: str, 
     message: dict,
     current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         user_message = message.get("message", "").strip()
@@ -382,10 +535,10 @@ async def chat_with_task(
 async def get_chat_history(
     task_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        task = db.query(Task).filter(Task.id == task_id, Task.user_id == current_user.id).first()
+        task = await get_user_task(db, task_id, current_user.id)
         if not task:
             raise HTTPException(404, "Task not found")
         
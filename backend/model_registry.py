@@ -0,0 +1,143 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from inference_backends import (
+    get_inference_backend, get_inference_precision, int8_activation_allowed, load_model
+)
+
+load_dotenv()
+
+# Registry name -> env var holding the weights path
+MODEL_PATH_ENV = {
+    "asexual": "ASEXUAL_MODEL_PATH",
+    "rbc": "RBC_MODEL_PATH",
+    "stage": "STAGE_MODEL_PATH",
+}
+# Optional single-pass detector with both parasite and RBC classes;
+# when configured it replaces the asexual + rbc pair
+OPTIONAL_MODEL_PATH_ENV = {
+    "combined": "COMBINED_MODEL_PATH",
+}
+
+WARMUP_IMAGE_SIZE = int(os.getenv("MODEL_WARMUP_IMAGE_SIZE", "640"))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hash a weights file without reading it into memory at once"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Process-level cache of the YOLO detectors used by the worker.
+
+    Models are loaded once per worker process (see the worker_process_init hook
+    in tasks.py) for the backend selected by INFERENCE_BACKEND (exporting to
+    ONNX/OpenVINO on first use), fused, put in eval mode and warmed up.
+    INFERENCE_PRECISION=int8 switches to the quantized ONNX models, but only
+    for weights that passed the accuracy guard in quantization.py.
+    Every lookup does a cheap os.stat on the weights file; only when size/mtime
+    changed is the file re-hashed, and the model is reloaded if the hash differs.
+    """
+
+    def __init__(self, backend=None, precision=None):
+        self.backend = backend or get_inference_backend()
+        self.precision = precision or get_inference_precision()
+        self._models = {}
+        self._stats = {}      # name -> (path, size, mtime_ns)
+        self.versions = {}    # name -> sha256 of the weights file
+        self.precisions = {}  # name -> precision actually loaded
+        self._lock = threading.Lock()
+
+    def _weights_path(self, name):
+        env_var = MODEL_PATH_ENV.get(name) or OPTIONAL_MODEL_PATH_ENV[name]
+        path = os.getenv(env_var)
+        if not path:
+            raise ValueError(f"{env_var} is not set")
+        return path
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime_ns)
+
+    def _prepare(self, model):
+        """Fuse conv+bn, switch to eval mode and run one warm-up inference"""
+        # Exported graphs are already fused/frozen at export time
+        if self.backend == "pytorch":
+            try:
+                model.fuse()
+            except Exception as e:
+                print(f"⚠️ Could not fuse model: {e}")
+            if hasattr(model, "model") and hasattr(model.model, "eval"):
+                model.model.eval()
+        warmup_frame = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+        model.predict(warmup_frame, verbose=False)
+        return model
+
+    def _load(self, name):
+        path = self._weights_path(name)
+        stat = self._stat(path)
+        version = file_sha256(path)
+        precision = self.precision
+        if precision == "int8" and not int8_activation_allowed(name, path, version):
+            print(f"⚠️ INT8 {name} model not activated (accuracy guard missing, failed or stale) - using fp32")
+            precision = "fp32"
+        model = self._prepare(load_model(path, self.backend, version, precision))
+
+        self._models[name] = model
+        self._stats[name] = stat
+        self.versions[name] = version
+        self.precisions[name] = precision
+        print(f"✅ Loaded {name} model from {path} (sha256 {version[:12]}, backend {self.backend}, {precision})")
+        return model
+
+    def _is_stale(self, name):
+        path = self._weights_path(name)
+        stat = self._stat(path)
+        if stat == self._stats.get(name):
+            return False
+
+        # File touched - only reload if the content actually changed
+        if file_sha256(path) == self.versions.get(name):
+            self._stats[name] = stat
+            return False
+        print(f"🔄 Weights for {name} model changed on disk, reloading")
+        return True
+
+    def get(self, name):
+        """Return the loaded model, (re)loading it if missing or stale"""
+        with self._lock:
+            if name not in self._models or self._is_stale(name):
+                return self._load(name)
+            return self._models[name]
+
+    def model_version(self, name):
+        """Identifies what produced a model's detections: weights hash, backend and precision"""
+        return f"{self.versions[name]}:{self.backend}:{self.precisions[name]}"
+
+    def get_models(self):
+        """Return (asexual_model, rbc_model, stage_model)"""
+        return self.get("asexual"), self.get("rbc"), self.get("stage")
+
+    def has_combined_model(self):
+        return bool(os.getenv(OPTIONAL_MODEL_PATH_ENV["combined"]))
+
+    def get_combined_model(self):
+        """Return the combined parasite+RBC detector, or None if not configured"""
+        return self.get("combined") if self.has_combined_model() else None
+
+    def load_all(self):
+        names = ["combined", "stage"] if self.has_combined_model() else list(MODEL_PATH_ENV)
+        for name in names:
+            self.get(name)
+
+
+# Global instance
+model_registry = ModelRegistry()
@@ -0,0 +1,166 @@
+import os
+import sys
+import glob
+import json
+import argparse
+from datetime import datetime
+import numpy as np
+import onnx
+from PIL import Image
+from dotenv import load_dotenv
+from onnxruntime import InferenceSession
+from onnxruntime.quantization import (
+    CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+)
+from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from functions import calculate_parasite_density
+from inference_backends import EXPORT_IMAGE_SIZE, ensure_exported, int8_artifact_path, int8_guard_path
+from model_registry import MODEL_PATH_ENV, file_sha256
+
+load_dotenv()
+
+DEFAULT_IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_images")
+
+
+class SmearCalibrationReader(CalibrationDataReader):
+    """Feeds test images through ultralytics-style preprocessing for static INT8 calibration"""
+
+    def __init__(self, onnx_path, image_paths, imgsz=EXPORT_IMAGE_SIZE):
+        self.input_name = InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        self.image_paths = list(image_paths)
+        self.letterbox = LetterBox(new_shape=(imgsz, imgsz), auto=False)
+        self._index = 0
+
+    def get_next(self):
+        if self._index >= len(self.image_paths):
+            return None
+        rgb = np.asarray(Image.open(self.image_paths[self._index]).convert("RGB"))
+        self._index += 1
+        frame = self.letterbox(image=rgb[..., ::-1])               # BGR, like predict()
+        tensor = frame[..., ::-1].transpose(2, 0, 1)[None]          # RGB, NCHW
+        return {self.input_name: np.ascontiguousarray(tensor, dtype=np.float32) / 255.0}
+
+    def rewind(self):
+        self._index = 0
+
+
+def _copy_metadata(src_path, dst_path):
+    """ultralytics reads class names/stride from the ONNX metadata; keep it on the quantized model"""
+    src = onnx.load(src_path)
+    dst = onnx.load(dst_path)
+    del dst.metadata_props[:]
+    dst.metadata_props.extend(src.metadata_props)
+    onnx.save(dst, dst_path)
+
+
+def quantize_model(weights_path, mode, image_paths):
+    """Export `weights_path` to FP32 ONNX (if needed) and write its INT8 variant next to it"""
+    fp32_path = ensure_exported(weights_path, "onnx", file_sha256(weights_path))
+    int8_path = int8_artifact_path(weights_path)
+
+    if mode == "dynamic":
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    else:
+        quantize_static(
+            fp32_path, int8_path,
+            SmearCalibrationReader(fp32_path, image_paths),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True
+        )
+    _copy_metadata(fp32_path, int8_path)
+    print(f"✅ Wrote {mode} INT8 model {int8_path}")
+    return fp32_path, int8_path
+
+
+def _density(models, image_paths, args):
+    return calculate_parasite_density(
+        image_paths, *models, args.target_rbc_count, args.repetitions,
+        batch_size=args.batch_size, stack_repetitions=True, seed=args.seed
+    )
+
+
+def run_accuracy_guard(fp32_models, int8_models, image_paths, args):
+    """
+    Compares INT8 against FP32 on the same seeded augmentations.
+    Returns (passed, metrics).
+    """
+    fp32_result = _density(fp32_models, image_paths, args)
+    int8_result = _density(int8_models, image_paths, args)
+    if fp32_result is None or int8_result is None:
+        return False, {"error": "density calculation returned no result"}
+
+    stages = set(fp32_result["average_stage_counts"]) | set(int8_result["average_stage_counts"])
+    stage_drift = {
+        stage: abs(fp32_result["average_stage_counts"].get(stage, 0) - int8_result["average_stage_counts"].get(stage, 0))
+        for stage in stages
+    }
+    metrics = {
+        "fp32_parasitemia_percent": float(fp32_result["average_parasitemia_percent"]),
+        "int8_parasitemia_percent": float(int8_result["average_parasitemia_percent"]),
+        "parasitemia_drift": float(abs(fp32_result["average_parasitemia_percent"] - int8_result["average_parasitemia_percent"])),
+        "stage_count_drift": stage_drift,
+    }
+    passed = (
+        metrics["parasitemia_drift"] <= args.max_parasitemia_drift
+        and max(stage_drift.values(), default=0) <= args.max_stage_drift
+    )
+    return passed, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build INT8 detector variants and run the accuracy guard")
+    parser.add_argument("--mode", choices=("static", "dynamic"), default="static")
+    parser.add_argument("--images", default=DEFAULT_IMAGE_DIR, help="Calibration / evaluation image directory")
+    parser.add_argument("--target-rbc-count", type=int, default=1000)
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-parasitemia-drift", type=float, default=0.25,
+                        help="Max allowed |INT8 - FP32| average parasitemia, in percentage points")
+    parser.add_argument("--max-stage-drift", type=float, default=2,
+                        help="Max allowed |INT8 - FP32| average count for any stage")
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))
+    if not image_paths:
+        print(f"❌ No .jpg images found in {args.images}")
+        return 1
+
+    weights = {}
+    fp32_models, int8_models = [], []
+    for name, env_var in MODEL_PATH_ENV.items():
+        weights_path = os.getenv(env_var)
+        weights[name] = file_sha256(weights_path)
+        fp32_path, int8_path = quantize_model(weights_path, args.mode, image_paths)
+        fp32_models.append(YOLO(fp32_path, task="detect"))
+        int8_models.append(YOLO(int8_path, task="detect"))
+
+    passed, metrics = run_accuracy_guard(fp32_models, int8_models, image_paths, args)
+    report = {
+        "passed": passed,
+        "mode": args.mode,
+        "weights": weights,  # FP32 weights the INT8 models were built from
+        "thresholds": {
+            "max_parasitemia_drift": args.max_parasitemia_drift,
+            "max_stage_drift": args.max_stage_drift,
+        },
+        "metrics": metrics,
+        "images": len(image_paths),
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    with open(int8_guard_path(), "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(metrics, indent=2))
+    if passed:
+        print("✅ INT8 models passed the accuracy guard - set INFERENCE_BACKEND=onnx INFERENCE_PRECISION=int8")
+        return 0
+    print("❌ INT8 drift exceeds the thresholds - quantized models will not be activated")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import os
+import json
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+TERMINAL_STATUSES = ("SUCCESS", "FAILED")
+
+_publisher = None
+_subscriber = None
+
+
+def task_channel(task_id):
+    return f"task-events:{task_id}"
+
+
+def publish_task_event(task_id, event):
+    """Publish a task status/progress event (worker side); failures never break the task"""
+    global _publisher
+    try:
+        if _publisher is None:
+            _publisher = redis.Redis.from_url(REDIS_URL)
+        _publisher.publish(task_channel(task_id), json.dumps(event, default=str))
+    except Exception as e:
+        print(f"⚠️ Failed to publish event for task {task_id}: {e}")
+
+
+async def subscribe_task_events(task_id):
+    """Subscribed pub/sub handle for one task's events (API side)"""
+    global _subscriber
+    if _subscriber is None:
+        _subscriber = aioredis.from_url(REDIS_URL)
+    pubsub = _subscriber.pubsub()
+    await pubsub.subscribe(task_channel(task_id))
+    return pubsub
+
+
+def format_sse(event, name=None):
+    lines = f"event: {name}\n" if name else ""
+    return f"{lines}data: {json.dumps(event, default=str)}\n\n"
+
+
+async def task_event_stream(pubsub, initial_event):
+    """
+    Server-Sent Events for one task: the current state first, then every
+    published event, ending after a SUCCESS/FAILED status. A comment line
+    is sent every SSE_HEARTBEAT_SECONDS so proxies keep the connection open.
+    """
+    try:
+        yield format_sse(initial_event, "status")
+        if initial_event.get("status") in TERMINAL_STATUSES:
+            return
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=SSE_HEARTBEAT_SECONDS)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            event = json.loads(message["data"])
+            yield format_sse(event, "status" if "status" in event else "progress")
+            if event.get("status") in TERMINAL_STATUSES:
+                return
+    finally:
+        # Also runs when the client disconnects
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
@@ -4,51 +4,290 @@ import torch
 import asyncio
 import requests
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from celery_app import celery_app
 from functions import calculate_parasite_density
+from sqlalchemy import update
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
 from ultralytics import YOLO
-from database import SessionLocal, Task
+from database import SessionLocal, Task, engine, result_summary
 from celery.exceptions import WorkerLostError
-from gcp_storage import gcp_storage 
+from celery.signals import worker_process_init
+from gcp_storage import gcp_storage, cas_content_hash
+from detection_cache import get_detection_cache
+from model_registry import model_registry
+from task_events import publish_task_event
 
 load_dotenv()
 
+_threads_configured = False
+_detection_cache = None  # one per worker process, see load_models_on_worker_init
+_detection_cache_ready = False
+
+def worker_detection_cache():
+    """
+    This process's DetectionCache (None when disabled). Normally created in
+    worker_process_init; built on first use under pools that never send that
+    signal (--pool=solo / threads).
+    """
+    global _detection_cache, _detection_cache_ready
+    if not _detection_cache_ready:
+        _detection_cache = get_detection_cache()
+        _detection_cache_ready = True
+    return _detection_cache
+
 def configure_8vcpu_threads():
-    """Configure for 8-vCPU processing"""
+    """Configure for 8-vCPU processing (once per process - torch rejects
+    changing interop threads after parallel work has started)"""
+    global _threads_configured
+    if _threads_configured:
+        return
     torch.set_num_threads(8)
     torch.set_num_interop_threads(8)
     os.environ['OMP_NUM_THREADS'] = '8'
     os.environ['MKL_NUM_THREADS'] = '8'
+    _threads_configured = True
+
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "60"))
+# Downloaded images stay in memory up to this many bytes per task, then spill to /tmp
+TASK_MEMORY_BUDGET_BYTES = int(os.getenv("TASK_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+
+def augmentation_seed(task_id):
+    """
+    AUGMENTATION_SEED if set (resubmitted images then reuse cached detections
+    across tasks), otherwise derived from the task ID so a retry repeats the
+    same augmentations and is served from the detection cache
+    """
+    if os.getenv("AUGMENTATION_SEED"):
+        return int(os.getenv("AUGMENTATION_SEED"))
+    return int(hashlib.sha256(task_id.encode()).hexdigest()[:8], 16)
+
+class ImageDownloadStream:
+    """
+    Downloads a task's images on a small thread pool (one pooled HTTP session)
+    and yields them in order as soon as each is ready, so inference starts on
+    the first image while the rest are still in flight. At most
+    DOWNLOAD_CONCURRENCY downloads run ahead of the consumer; close() cancels
+    whatever has not started when inference stops early.
+
+    Images are handed over as in-memory bytes; only once the task's
+    TASK_MEMORY_BUDGET_MB is used up are further images spilled to a temp
+    file (recorded in `temp_files`) and handed over as a path.
+    """
+
+    def __init__(self, task_id, image_urls, temp_files, check_timeout):
+        self.task_id = task_id
+        self.image_urls = image_urls
+        self.temp_files = temp_files  # shared with the task for cleanup
+        self.check_timeout = check_timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=DOWNLOAD_CONCURRENCY))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_CONCURRENCY))
+        self.executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY)
+        self._futures = {}
+        self._next_index = 0
+        self._closed = False
+        self._buffered_bytes = 0
+        self._lock = threading.Lock()
+        # Start fetching right away, before the consumer asks for the first image
+        while self._next_index < min(DOWNLOAD_CONCURRENCY, len(image_urls)):
+            self._submit_next()
+
+    def _download(self, i, url):
+        response = self.session.get(url, timeout=DOWNLOAD_TIMEOUT_SECONDS)
+        content = response.content
+        with self._lock:
+            keep_in_memory = self._buffered_bytes + len(content) <= TASK_MEMORY_BUDGET_BYTES
+            if keep_in_memory:
+                self._buffered_bytes += len(content)
+        if keep_in_memory:
+            return content
+
+        temp_file = f"/tmp/task_{self.task_id}_img_{i}.jpg"
+        self.temp_files.append(temp_file)
+        with open(temp_file, 'wb') as f:
+            f.write(content)
+        return temp_file
+
+    def _submit_next(self):
+        i = self._next_index
+        self._next_index += 1
+        url = self.image_urls[i]
+        if url.startswith('http'):
+            self._futures[i] = self.executor.submit(self._download, i, url)
+        else:
+            self._futures[i] = None  # local path, nothing to fetch
+
+    def __iter__(self):
+        try:
+            for i, url in enumerate(self.image_urls):
+                self.check_timeout()
+                future = self._futures.pop(i)
+                if self._next_index < len(self.image_urls):
+                    self._submit_next()
+                yield future.result() if future is not None else url
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for future in self._futures.values():
+            if future is not None:
+                future.cancel()
+        # Wait for in-flight downloads so no spill file is written after cleanup
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
+
+class TaskUnitOfWork:
+    """
+    One DB connection for all status writes of a single task run. Each write
+    is a targeted UPDATE ... WHERE id = task_id, so no Task rows are loaded.
+    A connection dropped during long inference is replaced once and the write retried.
+    Status and progress changes are also published for /events/{task_id} subscribers.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._connection = None
+
+    def _execute(self, statement):
+        if self._connection is None:
+            self._connection = engine.connect()
+        self._connection.execute(statement)
+        self._connection.commit()
+
+    def update(self, **values):
+        statement = update(Task).where(Task.id == self.task_id).values(**values)
+        try:
+            self._execute(statement)
+        except DBAPIError as e:
+            if not e.connection_invalidated:
+                # Leave the connection usable for the FAILED write that follows
+                # (None when engine.connect() itself failed)
+                if self._connection is not None:
+                    self._connection.rollback()
+                raise
+            self._discard_connection()
+            self._execute(statement)
+
+        if "status" in values:
+            publish_task_event(self.task_id, {"status": values["status"], "summary": values.get("summary")})
+        elif "progress" in values:
+            publish_task_event(self.task_id, {"progress": values["progress"]})
+
+    def _discard_connection(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.close()
+        except Exception as e:
+            print(f"⚠️ Failed to close dropped DB connection for task {self.task_id}: {e}")
+        self._connection = None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+PROGRESS_UPDATE_SECONDS = float(os.getenv("PROGRESS_UPDATE_SECONDS", "5"))
+
+class ProgressReporter:
+    """
+    progress_callback for calculate_parasite_density: writes the latest progress to
+    Task.progress at most every PROGRESS_UPDATE_SECONDS, so clients can poll
+    /progress/{task_id} instead of the full result. final() is written together
+    with the terminal status, so a finished task never shows throttled-out progress.
+    """
+
+    def __init__(self, task_db, start_time, min_interval=PROGRESS_UPDATE_SECONDS):
+        self.task_db = task_db
+        self.start_time = start_time
+        self.min_interval = min_interval
+        self._last_write = 0.0
+        self._latest = None
+
+    def _snapshot(self, progress, now):
+        return {
+            **progress,
+            "elapsed_seconds": round(now - self.start_time, 1),
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+
+    def __call__(self, progress):
+        self._latest = progress
+        now = time.time()
+        if now - self._last_write < self.min_interval:
+            return
+        self._last_write = now
+        self.task_db.update(progress=self._snapshot(progress, now))
+
+    def final(self):
+        """Last reported progress with nothing left in flight (None if nothing was reported)"""
+        if self._latest is None:
+            return None
+        return self._snapshot({**self._latest, "repetitions_in_progress": []}, time.time())
+
+def queued_task_count():
+    """Messages waiting in the broker's default queue (no DB scan); 0 if the broker can't be asked"""
+    try:
+        with celery_app.connection_or_acquire() as conn:
+            queue = conn.default_channel.queue_declare(
+                queue=celery_app.conf.task_default_queue, passive=True
+            )
+            return queue.message_count
+    except Exception as e:
+        print(f"⚠️ Could not read queue depth from broker: {e}")
+        return 0
+
+@worker_process_init.connect
+def load_models_on_worker_init(**kwargs):
+    """
+    Load and warm up the detectors once per worker process. Runs before the child
+    reports ready, so celery_app's worker_proc_alive_timeout must cover it.
+    """
+    configure_8vcpu_threads()
+    worker_detection_cache()
+    try:
+        model_registry.load_all()
+    except Exception as e:
+        # Tasks will retry the load lazily through the registry
+        print(f"⚠️ Failed to preload models at worker init: {e}")
 
 @celery_app.task(bind=True, autoretry_for=(WorkerLostError, ConnectionError, OSError))
 def process_malaria_images(self, task_id: str, image_urls: list):
     
     configure_8vcpu_threads()
     
-    temp_files = []
+    temp_files = []  # spill-over files written by image_stream
+    image_stream = None
+    task_db = TaskUnitOfWork(task_id)
     
-    db = SessionLocal()
-    queued_tasks = db.query(Task).filter(Task.status == "PROCESSING").count()
-    db.close()
+    queued_tasks = queued_task_count()
     
     timeout_minutes = 15 + (queued_tasks * 1)
     start_time = time.time()
     timeout_seconds = timeout_minutes * 60
+    progress_reporter = ProgressReporter(task_db, start_time)
     
     print(f"Task {task_id} timeout set to {timeout_minutes} minutes ({queued_tasks} queued tasks)")
     print(f"Using 8-vCPU single-task processing mode")
     
     try:        
-        db = SessionLocal()
-        task = db.query(Task).filter(Task.id == task_id).first()
-        if task:
-            task.status = "PROCESSING"
-            task.result = json.dumps({"status": "processing_started", "mode": "8-vCPU_single_task"})
-            db.commit()
-        db.close()
+        task_db.update(
+            status="PROCESSING",
+            result=json.dumps({"status": "processing_started", "mode": "8-vCPU_single_task"}),
+            summary=None,
+            progress=None
+        )
         
         def check_timeout():
             if time.time() - start_time > timeout_seconds:
@@ -56,44 +295,57 @@ def process_malaria_images(self, task_id: str, image_urls: list):
         
         check_timeout()
         
-        for i, url in enumerate(image_urls):
-            check_timeout()
-            
-            if url.startswith('http'):
-                response = requests.get(url)
-                temp_file = f"/tmp/task_{task_id}_img_{i}.jpg"
-                with open(temp_file, 'wb') as f:
-                    f.write(response.content)
-                temp_files.append(temp_file)
-            else:
-                temp_files.append(url)
+        # Downloads overlap with model lookup and inference
+        image_stream = ImageDownloadStream(task_id, image_urls, temp_files, check_timeout)
         
         check_timeout()
         
-        asexual_model = YOLO(os.getenv("ASEXUAL_MODEL_PATH"))
-        rbc_model = YOLO(os.getenv("RBC_MODEL_PATH"))
-        stage_model = YOLO(os.getenv("STAGE_MODEL_PATH"))
+        combined_model = model_registry.get_combined_model()
+        if combined_model is not None:
+            # One forward pass per frame yields both parasites and RBCs
+            asexual_model, rbc_model = None, None
+        else:
+            asexual_model, rbc_model = model_registry.get("asexual"), model_registry.get("rbc")
+        stage_model = model_registry.get("stage")
+        model_names = ["combined", "stage"] if combined_model is not None else ["asexual", "rbc", "stage"]
+        model_versions = {name: model_registry.model_version(name) for name in model_names}
         
         check_timeout()
         
         result = calculate_parasite_density(
-            temp_files, asexual_model, rbc_model, stage_model, 1000, 5
+            image_stream, asexual_model, rbc_model, stage_model, 1000, 5,
+            batch_size=int(os.getenv("INFERENCE_BATCH_SIZE", "8")),
+            stack_repetitions=os.getenv("STACK_REPETITIONS", "true").lower() == "true",
+            stage_concurrent=os.getenv("STAGE_CONCURRENT", "false").lower() == "true",
+            adaptive=os.getenv("ADAPTIVE_REPETITIONS", "false").lower() == "true",
+            min_repetitions=int(os.getenv("ADAPTIVE_MIN_REPETITIONS", "2")),
+            ci_tolerance=float(os.getenv("ADAPTIVE_CI_TOLERANCE", "0.5")),
+            combined_model=combined_model,
+            combined_parasite_class_ids=(
+                [int(c) for c in os.getenv("COMBINED_PARASITE_CLASS_IDS").split(",")]
+                if os.getenv("COMBINED_PARASITE_CLASS_IDS") else None
+            ),
+            combined_rbc_class_id=int(os.getenv("COMBINED_RBC_CLASS_ID", "0")),
+            tile_size=int(os.getenv("TILE_SIZE")) if os.getenv("TILE_SIZE") else None,
+            tile_overlap=float(os.getenv("TILE_OVERLAP", "0.2")),
+            seed=augmentation_seed(task_id),
+            detection_cache=worker_detection_cache(),
+            model_versions=model_versions,
+            progress_callback=progress_reporter,
+            # Content-addressed images carry their hash in the name
+            image_hashes=[cas_content_hash(url) for url in image_urls]
         )
         
-        db = SessionLocal()
-        task = db.query(Task).filter(Task.id == task_id).first()
-        if task:
-            task.status = "SUCCESS"
-            task.result = json.dumps(result)
-            db.commit()
-        db.close()
+        if result is None:
+            # calculate_parasite_density logs the cause and returns None on bad input
+            raise ValueError("Parasite density calculation returned no result (no readable images?)")
         
-        for file_path in temp_files:
-            if file_path.startswith('/tmp/'):
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
+        task_db.update(
+            status="SUCCESS",
+            result=json.dumps(result),
+            summary=result_summary(result),
+            progress=progress_reporter.final()
+        )
         
         elapsed_time = (time.time() - start_time) / 60
         print(f"✅ Task {task_id} completed in {elapsed_time:.1f} minutes using 8-vCPU processing")
@@ -103,26 +355,18 @@ def process_malaria_images(self, task_id: str, image_urls: list):
         error_msg = str(timeout_error)
         print(f"⏱️ Task {task_id} timed out: {error_msg}")
         
-        for file_path in temp_files:
-            if file_path.startswith('/tmp/'):
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-        
         try:
-            db = SessionLocal()
-            task = db.query(Task).filter(Task.id == task_id).first()
-            if task:
-                task.status = "FAILED"
-                task.result = json.dumps({
+            task_db.update(
+                status="FAILED",
+                summary=result_summary({"error": error_msg}),
+                progress=progress_reporter.final(),
+                result=json.dumps({
                     "error": error_msg,
                     "timeout": True,
                     "elapsed_minutes": (time.time() - start_time) / 60,
                     "mode": "8-vCPU_single_task"
                 })
-                db.commit()
-            db.close()
+            )
         except Exception as db_error:
             print(f"Failed to update timeout status: {db_error}")
         
@@ -133,56 +377,103 @@ def process_malaria_images(self, task_id: str, image_urls: list):
         elapsed_time = (time.time() - start_time) / 60
         print(f"Task {task_id} failed after {elapsed_time:.1f} minutes: {error_msg}")
         
-        for file_path in temp_files:
-            if file_path.startswith('/tmp/'):
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-        
         try:
-            db = SessionLocal()
-            task = db.query(Task).filter(Task.id == task_id).first()
-            if task:
-                task.status = "FAILED"
-                task.result = json.dumps({
+            task_db.update(
+                status="FAILED",
+                summary=result_summary({"error": error_msg}),
+                progress=progress_reporter.final(),
+                result=json.dumps({
                     "error": error_msg,
                     "elapsed_minutes": elapsed_time,
                     "mode": "8-vCPU_single_task"
                 })
-                db.commit()
-            db.close()
+            )
         except Exception as db_error:
             print(f"Failed to update task status: {db_error}")
         
         return {"error": error_msg}
+    
+    finally:
+        task_db.close()
+        # Only spill-over files ever land in /tmp
+        if image_stream is not None:
+            image_stream.close()
+        for file_path in temp_files:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
 
 @celery_app.task
 def cleanup_orphaned_tasks():
-    """Clean up stuck tasks"""
+    """Clean up stuck tasks (periodic, see celery_app beat_schedule)"""
     try:
         db = SessionLocal()
         now = datetime.utcnow()
         
-        stuck_tasks = db.query(Task).filter(
-            Task.status == "PROCESSING",
-            Task.created_at < now - timedelta(hours=1)
-        ).all()
+        # One UPDATE ... WHERE instead of loading and rewriting each row
+        summary = result_summary({"error": "Task exceeded timeout"})
+        failed_ids = db.execute(
+            update(Task)
+            .where(Task.status == "PROCESSING", Task.created_at < now - timedelta(hours=1))
+            .values(
+                status="FAILED",
+                result=json.dumps({
+                    "error": "Task exceeded timeout",
+                    "cleanup_time": now.isoformat()
+                }),
+                summary=summary,
+                progress=None  # the worker died mid-run; its last progress is stale
+            )
+            .returning(Task.id)
+        ).scalars().all()
+        db.commit()
         
-        cleanup_count = 0
-        for task in stuck_tasks:
-            task.status = "FAILED"
-            task.result = json.dumps({
-                "error": "Task exceeded timeout",
-                "cleanup_time": now.isoformat()
-            })
-            cleanup_count += 1
+        db.close()
+        for task_id in failed_ids:
+            publish_task_event(task_id, {"status": "FAILED", "summary": summary})
+        return f"Cleaned up {len(failed_ids)} stuck tasks"
         
-        if cleanup_count > 0:
-            db.commit()
+    except Exception as e:
+        return f"Cleanup failed: {e}"
+
+@celery_app.task
+def delete_expired_tasks():
+    """Delete tasks older than TASK_RETENTION_HOURS and queue cleanup of their images"""
+    try:
+        db = SessionLocal()
+        cutoff = datetime.utcnow() - timedelta(hours=int(os.getenv("TASK_RETENTION_HOURS", "42")))
+        expired = db.query(Task).filter(Task.created_at < cutoff)
         
+        tasks_with_images = [task_id for (task_id,) in expired.filter(Task.image_urls.isnot(None)).with_entities(Task.id)]
+        deleted_count = expired.delete(synchronize_session=False)
+        db.commit()
         db.close()
-        return f"Cleaned up {cleanup_count} stuck tasks"
         
+        for task_id in tasks_with_images:
+            delete_task_images.delay(task_id)
+        return f"Deleted {deleted_count} expired tasks ({len(tasks_with_images)} with images)"
+        
+    except Exception as e:
+        return f"Expired task cleanup failed: {e}"
+
+@celery_app.task(bind=True, max_retries=5)
+def delete_task_images(self, task_id: str):
+    """Background image cleanup, so API handlers return without waiting on deletes"""
+    try:
+        gcp_storage.purge_task_images(task_id)
+        return f"Cleaned up images for task {task_id}"
+    except Exception as e:
+        print(f"⚠️ Image cleanup for task {task_id} failed, retrying: {e}")
+        raise self.retry(exc=e, countdown=60)
+
+@celery_app.task
+def sweep_old_images(days_old: int = None):
+    """Scheduled sweep of task images nobody cleaned up (see celery_app beat_schedule)"""
+    if days_old is None:
+        days_old = int(os.getenv("IMAGE_RETENTION_DAYS", "7"))
+    try:
+        purged = gcp_storage.sweep_old_images(days_old)
+        return f"Swept images of {purged} tasks"
     except Exception as e:
-        return f"Cleanup failed: {e}"
\ No newline at end of file
+        return f"Image sweep failed: {e}"
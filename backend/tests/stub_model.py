@@ -0,0 +1,54 @@
+"""Deterministic stand-in for a YOLO model, for tests that run calculate_parasite_density"""
+import numpy as np
+import torch
+
+
+class _Boxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = torch.tensor(xyxy, dtype=torch.float32).reshape(-1, 4)
+        self.conf = torch.tensor(conf, dtype=torch.float32)
+        self.cls = torch.tensor(cls, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubModel:
+    """
+    Detects a number of small, non-overlapping boxes that depends only on the
+    frame's pixels, cycling through `class_ids`. Records the shape of every
+    frame it is asked to predict.
+    """
+
+    def __init__(self, class_ids=(0,), base_count=3, spread=4):
+        self.class_ids = list(class_ids)
+        self.base_count = base_count
+        self.spread = spread
+        self.frame_shapes = []
+
+    def _detect(self, frame):
+        self.frame_shapes.append(frame.shape)
+        n = self.base_count + int(frame.sum(dtype=np.int64)) % self.spread
+        per_row = max(1, frame.shape[1] // 12)
+        boxes = [
+            (12 * (k % per_row), 12 * (k // per_row), 12 * (k % per_row) + 8, 12 * (k // per_row) + 8)
+            for k in range(n)
+        ]
+        classes = [self.class_ids[k % len(self.class_ids)] for k in range(n)]
+        return _Result(_Boxes(boxes, [0.9] * n, classes))
+
+    def predict(self, frames, verbose=False):
+        if isinstance(frames, np.ndarray) and frames.ndim == 3:
+            frames = [frames]
+        return [self._detect(np.asarray(frame)) for frame in frames]
+
+
+def smear_images(count, size=(96, 128), seed=0):
+    """Random RGB uint8 arrays standing in for decoded smear photos"""
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, size=size + (3,), dtype=np.uint8) for _ in range(count)]
@@ -0,0 +1,60 @@
+import os
+import glob
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+ImageEnhance = pytest.importorskip("PIL.ImageEnhance")
+
+from augmentation import augment_batch, sample_augmentation_params
+
+
+def pil_augment(image, contrast, sharpness, saturation):
+    """The per-image PIL chain augment_batch replaced"""
+    pil_image = Image.fromarray(image)
+    pil_image = ImageEnhance.Contrast(pil_image).enhance(contrast)
+    pil_image = ImageEnhance.Sharpness(pil_image).enhance(sharpness)
+    pil_image = ImageEnhance.Color(pil_image).enhance(saturation)
+    return np.asarray(pil_image)
+
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), "..", "..", "test_images")
+
+
+@pytest.fixture
+def smear_image():
+    paths = sorted(glob.glob(os.path.join(TEST_IMAGES, "*.jpg")))
+    if not paths:
+        pytest.skip("no test_images checked out")
+    with Image.open(paths[0]) as image:
+        return np.asarray(image.convert("RGB"))[:256, :256]
+
+
+def test_augment_batch_matches_pil_chain(smear_image):
+    params = sample_augmentation_params(np.random.default_rng(42), n=6)
+    batch = augment_batch(smear_image, params)
+
+    assert batch.shape == (6,) + smear_image.shape
+    assert batch.dtype == np.uint8
+    for augmented, (contrast, sharpness, saturation) in zip(batch, params):
+        expected = pil_augment(smear_image, contrast, sharpness, saturation)
+        diff = np.abs(augmented.astype(np.int16) - expected.astype(np.int16))
+        # Rounded/clipped once at the end instead of after every stage
+        assert diff.mean() < 2
+        assert diff.max() <= 8
+
+
+def test_augment_batch_bgr_reverses_channels(smear_image):
+    params = sample_augmentation_params(np.random.default_rng(1), n=2)
+    rgb = augment_batch(smear_image, params)
+    bgr = augment_batch(smear_image, params, bgr=True)
+    np.testing.assert_array_equal(bgr, rgb[..., ::-1])
+
+
+def test_sample_augmentation_params_is_seeded():
+    a = sample_augmentation_params(np.random.default_rng(7), n=4)
+    b = sample_augmentation_params(np.random.default_rng(7), n=4)
+    np.testing.assert_array_equal(a, b)
+    assert a.shape == (4, 3)
+    assert ((a[:, 0] >= 1.0) & (a[:, 0] <= 2.0)).all()
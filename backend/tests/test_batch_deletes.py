@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+pytest.importorskip("fastapi")
+requests = pytest.importorskip("requests")
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from gcp_storage import GCPStorageService
+
+
+def batch_response(status_codes):
+    """multipart/mixed reply of a GCS batch request with one status per sub-request"""
+    parts = [
+        f"--BOUNDARY\nContent-Type: application/http\nContent-ID: <response-{i + 1}>\n\n"
+        f"HTTP/1.1 {code} X\nContent-Type: application/json\n\n{{}}\n"
+        for i, code in enumerate(status_codes)
+    ]
+    response = requests.Response()
+    response.status_code = 200
+    response._content = ("".join(parts) + "--BOUNDARY--").encode()
+    response.headers["content-type"] = "multipart/mixed; boundary=BOUNDARY"
+    return response
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = GCPStorageService.__new__(GCPStorageService)
+    service.use_local_storage = False
+    service.client = storage.Client(project="test", credentials=AnonymousCredentials())
+    service.bucket = service.client.bucket("test-bucket")
+    service.sent = []
+
+    def send_batch(method, url, data=None, headers=None, timeout=None, **kwargs):
+        codes = service.status_codes[len(service.sent)]
+        service.sent.append(data.count("DELETE "))
+        return batch_response(codes)
+
+    monkeypatch.setattr(service.client._base_connection, "_make_request", send_batch)
+    return service
+
+
+def test_missing_blobs_are_ignored(service):
+    service.status_codes = [[204, 404, 204]]
+    service._delete_blobs([service.bucket.blob(f"tasks/t/{i}.jpg") for i in range(3)])
+    assert service.sent == [3]
+
+
+def test_other_failures_raise_after_every_chunk(service):
+    service.status_codes = [[204] * 100, [204, 503]]
+    with pytest.raises(Exception, match="1 of 102 blobs.*HTTP 503"):
+        service._delete_blobs([service.bucket.blob(f"tasks/t/{i}.jpg") for i in range(102)])
+    assert service.sent == [100, 2]
@@ -0,0 +1,132 @@
+import os
+
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+pytest.importorskip("fastapi")
+
+from gcp_storage import CAS_PREFIX, LOCAL_UPLOAD_ROOT, GCPStorageService, _cas_key, cas_content_hash
+
+SHA = "ab" * 32
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = GCPStorageService.__new__(GCPStorageService)
+    service.use_local_storage = True
+    os.makedirs(os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX))
+    return service
+
+
+def incoming(content=b"image bytes"):
+    path = os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, f".incoming_{os.urandom(4).hex()}")
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def refs(key):
+    refs_dir = os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, "refs", key)
+    return sorted(os.listdir(refs_dir)) if os.path.isdir(refs_dir) else []
+
+
+def test_identical_images_are_stored_once_and_referenced_per_task(storage):
+    key = _cas_key(SHA, "smear.JPG")
+    first = storage._store_local_cas_file("task-a", key, incoming())
+    second_incoming = incoming()
+    second = storage._store_local_cas_file("task-b", key, second_incoming)
+
+    assert first == second == os.path.join(LOCAL_UPLOAD_ROOT, CAS_PREFIX, f"{SHA}.jpg")
+    assert not os.path.exists(second_incoming)
+    assert refs(key) == ["task-a", "task-b"]
+    assert os.path.exists(os.path.join(LOCAL_UPLOAD_ROOT, "task-b", CAS_PREFIX, key))
+
+
+def test_image_is_deleted_with_its_last_reference(storage):
+    key = _cas_key(SHA, "smear.jpg")
+    path = storage._store_local_cas_file("task-a", key, incoming())
+    storage._store_local_cas_file("task-b", key, incoming())
+
+    storage._release_cas_ref("task-a", key)
+    assert os.path.exists(path)
+    assert refs(key) == ["task-b"]
+
+    storage._release_cas_ref("task-b", key)
+    assert not os.path.exists(path)
+    assert refs(key) == []
+
+
+def test_released_image_can_be_stored_again(storage):
+    key = _cas_key(SHA, "smear.jpg")
+    storage._store_local_cas_file("task-a", key, incoming())
+    storage._release_cas_ref("task-a", key)
+
+    path = storage._store_local_cas_file("task-c", key, incoming(b"same bytes again"))
+    with open(path, "rb") as f:
+        assert f.read() == b"same bytes again"
+    assert refs(key) == ["task-c"]
+
+
+def test_purge_releases_only_that_tasks_references(storage):
+    key = _cas_key(SHA, "smear.jpg")
+    path = storage._store_local_cas_file("task-a", key, incoming())
+    storage._store_local_cas_file("task-b", key, incoming())
+
+    storage.purge_task_images("task-a")
+    assert not os.path.exists(os.path.join(LOCAL_UPLOAD_ROOT, "task-a"))
+    assert os.path.exists(path)
+
+    storage.purge_task_images("task-b")
+    assert not os.path.exists(path)
+
+
+def test_cas_content_hash_reads_stored_names():
+    assert cas_content_hash(f"uploads/cas/{SHA}.jpg") == SHA
+    assert cas_content_hash(f"https://storage.googleapis.com/bucket/cas/{SHA}.png?X-Goog-Signature=x") == SHA
+    assert cas_content_hash("uploads/task-a/smear.jpg") is None
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.metageneration = None
+
+    def upload_from_string(self, content, content_type=None, if_generation_match=None):
+        self.bucket.uploads.append(self.name)
+        self.bucket.blobs[self.name] = self
+        self.metageneration = 1
+
+    def patch(self, if_metageneration_match=None):
+        assert if_metageneration_match == self.metageneration
+        self.metageneration += 1
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs = {}
+        self.uploads = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+
+def test_gcs_duplicate_image_is_not_uploaded_again():
+    service = GCPStorageService.__new__(GCPStorageService)
+    service.use_local_storage = False
+    service.bucket = FakeBucket()
+    key = _cas_key(SHA, "smear.jpg")
+
+    service._store_cas_blob("task-a", key, b"image bytes", "image/jpeg")
+    blob = service._store_cas_blob("task-b", key, b"image bytes", "image/jpeg")
+
+    image_uploads = [name for name in service.bucket.uploads if name == f"{CAS_PREFIX}/{key}"]
+    assert image_uploads == [f"{CAS_PREFIX}/{key}"]
+    # Touched, so a concurrent conditional delete of the old metageneration fails
+    assert blob.metageneration == 2
+    assert f"{CAS_PREFIX}/refs/{key}/task-b" in service.bucket.uploads
@@ -0,0 +1,83 @@
+import importlib
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("aiosqlite")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'tasks.db'}")
+    monkeypatch.delenv("ASYNC_DATABASE_URL", raising=False)
+    import database
+    database = importlib.reload(database)
+    database.Base.metadata.create_all(bind=database.engine)
+    yield database
+    database.engine.dispose()
+
+
+def insert_task(database, task_id, **values):
+    with database.SessionLocal() as db:
+        db.add(database.Task(id=task_id, user_id=values.pop("user_id", "user-1"), **values))
+        db.commit()
+
+
+LEGACY_RESULT = {
+    # Written before repetitions_run existed
+    "average_parasitemia_percent": 1.5,
+    "average_parasite_density_per_1000_rbc": 15.0,
+    "average_stage_counts": {"ring": 2.0},
+    "all_run_results": [{}, {}, {}],
+}
+
+
+def test_result_summary_of_legacy_result(database):
+    assert database.result_summary(LEGACY_RESULT)["repetitions_run"] == 3
+    assert database.result_summary({"error": "boom"}) == {"error": "boom"}
+    assert database.result_summary(None) is None
+
+
+def test_backfill_fills_legacy_and_error_rows(database):
+    insert_task(database, "legacy", status="SUCCESS", result=json.dumps(LEGACY_RESULT))
+    insert_task(database, "failed", status="FAILED", result=json.dumps({"error": "boom"}))
+    insert_task(database, "running", status="PROCESSING", result=json.dumps({"status": "processing_started"}))
+    insert_task(database, "pending", status="PENDING")
+
+    assert database.backfill_task_summaries() == 2
+
+    with database.SessionLocal() as db:
+        summaries = {task.id: task.summary for task in db.query(database.Task)}
+    assert summaries["legacy"] == {
+        "average_parasitemia_percent": 1.5,
+        "average_parasite_density_per_1000_rbc": 15.0,
+        "average_stage_counts": {"ring": 2.0},
+        "repetitions_run": 3,
+    }
+    assert summaries["failed"] == {"error": "boom"}
+    assert summaries["running"] is None
+    assert summaries["pending"] is None
+
+
+def test_task_pages_follow_the_cursor_across_created_at_ties(database):
+    start = datetime(2026, 1, 1)
+    # Two tasks share a timestamp, so the id tie-break decides their order
+    created = {"t1": start, "t2": start + timedelta(minutes=1), "t3": start + timedelta(minutes=1),
+               "t4": start + timedelta(minutes=2), "t5": start + timedelta(minutes=3)}
+    for task_id, created_at in created.items():
+        insert_task(database, task_id, created_at=created_at)
+    insert_task(database, "other", user_id="user-2", created_at=start + timedelta(minutes=5))
+
+    seen, after = [], None
+    with database.engine.connect() as conn:
+        while True:
+            rows = conn.execute(database.task_page_query("user-1", 2, after)).all()
+            page = rows[:2]
+            seen.extend(row.id for row in page)
+            if len(rows) <= 2:
+                break
+            after = (page[-1].created_at, page[-1].id)
+
+    assert seen == ["t5", "t4", "t3", "t2", "t1"]
@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("ultralytics")
+
+from functions import calculate_parasite_density
+from stub_model import StubModel, smear_images
+
+
+def density(images, **kwargs):
+    options = dict(target_rbc_count=40, repetitions=3, seed=11)
+    options.update(kwargs)
+    # Parasite and RBC counts vary independently, so parasitemia differs between repetitions
+    return calculate_parasite_density(images, StubModel(base_count=1, spread=3), StubModel(), **options)
+
+
+@pytest.fixture
+def images():
+    return smear_images(10)
+
+
+def test_batched_predicts_match_one_frame_at_a_time(images):
+    sequential = density(images, batch_size=1)
+    batched = density(images, batch_size=4)
+
+    # The target is reached part-way through a batch; later frames must not count
+    assert any(run["images_processed"] % 4 for run in sequential["all_run_results"])
+    assert batched["all_run_results"] == sequential["all_run_results"]
+    assert batched["average_parasitemia_percent"] == sequential["average_parasitemia_percent"]
+
+
+def test_stacked_repetitions_match_sequential(images):
+    sequential = density(images, batch_size=4)
+    stacked = density(images, batch_size=4, stack_repetitions=True)
+
+    runs = sequential["all_run_results"]
+    assert len({run["parasite_count"] for run in runs}) > 1  # repetitions really differ
+    assert stacked["all_run_results"] == runs
+    assert stacked["total_rbcs_counted_per_run"] == sequential["total_rbcs_counted_per_run"]
+
+
+def test_fixed_repetitions_report_their_stopping_reason(images):
+    result = density(images)
+    assert result["repetitions_run"] == 3
+    assert result["stopping_reason"] == "fixed_repetitions"
+    assert result["parasitemia_ci_half_width"] is None
+
+
+def test_adaptive_stops_once_the_estimate_converges(images):
+    # Every frame yields the same counts, so the interval is zero after min_repetitions
+    result = calculate_parasite_density(
+        images, StubModel(spread=1), StubModel(spread=1), target_rbc_count=40,
+        repetitions=6, seed=11, adaptive=True, min_repetitions=2, ci_tolerance=0.5
+    )
+    assert result["repetitions_run"] == 2
+    assert result["stopping_reason"] == "converged"
+    assert result["parasitemia_ci_half_width"] == 0.0
+
+
+def test_adaptive_runs_up_to_the_maximum_without_converging(images):
+    result = density(images, repetitions=4, adaptive=True, min_repetitions=2, ci_tolerance=1e-9)
+    assert result["repetitions_run"] == 4
+    assert result["stopping_reason"] == "max_repetitions"
+    assert result["parasitemia_ci_half_width"] > 0
+
+
+def test_adaptive_repetitions_match_the_fixed_run(images):
+    # Same seed: the repetitions adaptive mode does run are the fixed mode's first ones
+    fixed = density(images, repetitions=4)
+    adaptive = density(images, repetitions=4, adaptive=True, min_repetitions=2, ci_tolerance=100)
+    assert adaptive["stopping_reason"] == "converged"
+    assert adaptive["all_run_results"] == fixed["all_run_results"][:adaptive["repetitions_run"]]
+
+
+def test_adaptive_rejects_min_repetitions_above_the_maximum(images):
+    assert density(images, repetitions=2, adaptive=True, min_repetitions=3) is None
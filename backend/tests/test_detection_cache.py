@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from detection_cache import DetectionCache, detection_cache_key
+
+
+def detections(n, class_id=0):
+    boxes = np.arange(n * 4, dtype=np.float32).reshape(n, 4)
+    return boxes, np.full(n, 0.5, dtype=np.float32), np.full(n, class_id, dtype=np.int64)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DetectionCache(backend="disk", cache_dir=str(tmp_path / "cache"))
+
+
+def test_disk_round_trip(cache):
+    key = detection_cache_key("a" * 64, [1.5, 2.0, 0.8], "weights-v1", "full")
+    cache.put_many({key: detections(3, class_id=2)})
+
+    hit, miss = cache.get_many([key, detection_cache_key("a" * 64, [1.5, 2.0, 0.8], "weights-v2", "full")])
+    boxes, scores, classes = hit
+    np.testing.assert_array_equal(boxes, detections(3)[0])
+    np.testing.assert_array_equal(classes, [2, 2, 2])
+    assert miss is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_empty_detections_are_cached(cache):
+    cache.put_many({"k" * 64: detections(0)})
+    (boxes, scores, classes), = cache.get_many(["k" * 64])
+    assert boxes.shape == (0, 4) and len(classes) == 0
+
+
+def test_expired_entries_are_misses(cache):
+    cache.put_many({"k" * 64: detections(1)})
+    cache.ttl_seconds = 60
+    path = cache._disk_path("k" * 64)
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert cache.get_many(["k" * 64]) == [None]
+    assert not os.path.exists(path)
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    payload_bytes = len(np.zeros((10, 6), dtype=np.float32).tobytes())
+    cache.max_bytes = payload_bytes * 3
+    for n, key in enumerate(("a" * 64, "b" * 64, "c" * 64)):
+        cache.put_many({key: detections(10)})
+        os.utime(cache._disk_path(key), (time.time() - 100 + n, time.time() - 100 + n))
+    cache.get_many(["a" * 64])  # touch the oldest
+    cache.put_many({"d" * 64: detections(10)})
+
+    kept = [key[0] for key in ("a" * 64, "b" * 64, "c" * 64, "d" * 64) if os.path.exists(cache._disk_path(key))]
+    assert "b" not in kept
+    assert "a" in kept and "d" in kept
+
+
+def test_repeated_run_is_served_from_the_cache(cache):
+    pytest.importorskip("torch")
+    pytest.importorskip("ultralytics")
+    from functions import calculate_parasite_density
+    from stub_model import StubModel, smear_images
+
+    # Decoded arrays have no bytes to hash, so their content hashes are passed in
+    arrays = smear_images(4)
+    hashes = [f"{i:064x}" for i in range(4)]
+
+    def run():
+        parasite_model, rbc_model = StubModel(), StubModel()
+        result = calculate_parasite_density(
+            arrays, parasite_model, rbc_model, target_rbc_count=1000, repetitions=2,
+            seed=3, detection_cache=cache, model_versions={"asexual": "p1", "rbc": "r1"},
+            image_hashes=hashes
+        )
+        return result, len(parasite_model.frame_shapes) + len(rbc_model.frame_shapes)
+
+    first, first_predicts = run()
+    second, second_predicts = run()
+    assert first_predicts > 0
+    assert second_predicts == 0
+    assert second["all_run_results"] == first["all_run_results"]
@@ -0,0 +1,83 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from tiling import merge_tile_detections, tile_windows
+
+
+def merge(detections, threshold=0.5):
+    boxes = np.array([d[0] for d in detections], dtype=np.float32)
+    scores = np.array([d[1] for d in detections], dtype=np.float32)
+    classes = np.array([d[2] for d in detections])
+    tile_ids = np.array([d[3] for d in detections])
+    return sorted(merge_tile_detections(boxes, scores, classes, tile_ids, threshold).tolist())
+
+
+def test_tile_windows_cover_image_with_edge_flush_tiles():
+    windows = tile_windows(1000, 1500, 640, overlap=0.2)
+    assert windows[0] == (0, 0, 640, 640)
+    assert max(x1 for _, _, x1, _ in windows) == 1500
+    assert max(y1 for _, _, _, y1 in windows) == 1000
+    assert all(x1 - x0 == 640 and y1 - y0 == 640 for x0, y0, x1, y1 in windows)
+
+
+def test_tile_windows_small_image_is_one_window():
+    assert tile_windows(300, 400, 640) == [(0, 0, 400, 300)]
+
+
+def test_cell_cut_by_tile_border_is_merged():
+    # Full cell seen by tile 0, its right half clipped at the border of tile 1
+    detections = [
+        ((100, 100, 140, 140), 0.9, 0, 0),
+        ((120, 100, 140, 140), 0.7, 0, 1),
+    ]
+    assert merge(detections) == [0]
+
+
+def test_overlapping_cells_within_one_tile_are_kept():
+    # Touching cells the model already separated in the same tile
+    detections = [
+        ((100, 100, 140, 140), 0.9, 0, 0),
+        ((110, 100, 150, 140), 0.8, 0, 0),
+    ]
+    assert merge(detections) == [0, 1]
+
+
+def test_different_classes_are_not_merged():
+    # A parasite inside an RBC, reported by neighbouring tiles
+    detections = [
+        ((100, 100, 140, 140), 0.9, 0, 0),
+        ((110, 110, 130, 130), 0.8, 1, 1),
+    ]
+    assert merge(detections) == [0, 1]
+
+
+def test_small_overlap_across_tiles_is_kept():
+    detections = [
+        ((100, 100, 140, 140), 0.9, 0, 0),
+        ((135, 100, 175, 140), 0.8, 0, 1),
+    ]
+    assert merge(detections) == [0, 1]
+
+
+def test_no_detections():
+    empty = np.zeros((0, 4), dtype=np.float32)
+    assert merge_tile_detections(empty, np.zeros(0), np.zeros(0), np.zeros(0)).size == 0
+
+
+def test_stage_model_sees_tiles_when_tiling():
+    pytest.importorskip("torch")
+    pytest.importorskip("ultralytics")
+    from functions import calculate_parasite_density
+    from stub_model import StubModel, smear_images
+
+    stage_model = StubModel(class_ids=(1, 3))
+    result = calculate_parasite_density(
+        smear_images(3, size=(100, 100)), StubModel(), StubModel(), stage_model,
+        target_rbc_count=1000, repetitions=1, seed=1,
+        stage_class_map={"trophozoite": 1, "ring": 3}, tile_size=64, tile_overlap=0.25
+    )
+
+    assert stage_model.frame_shapes
+    assert all(shape[:2] == (64, 64) for shape in stage_model.frame_shapes)
+    assert result["average_stage_counts"]["ring"] > 0
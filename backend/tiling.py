@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def _axis_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)  # last tile flush with the edge
+    return starts
+
+
+def tile_windows(height, width, tile_size, overlap=0.2):
+    """
+    Overlapping (x0, y0, x1, y1) windows covering a height x width image.
+    Images smaller than a tile give a single window over the whole image.
+    """
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return [
+        (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in _axis_starts(height, tile_size, stride)
+        for x0 in _axis_starts(width, tile_size, stride)
+    ]
+
+
+def merge_tile_detections(boxes, scores, classes, tile_ids, threshold=0.5):
+    """
+    Greedy cross-tile suppression of duplicate detections.
+
+    A box is dropped when a higher-scoring box of the same class from a
+    *different* tile covers more than `threshold` of the smaller of the two
+    (intersection over smaller area, so a cell cut in half by a tile border is
+    still matched to its full box). Detections within one tile were already
+    NMS'd by the model and are never merged with each other.
+
+    Args:
+        boxes (np.ndarray): (N, 4) xyxy boxes in full-image coordinates.
+        scores (np.ndarray): (N,) confidences.
+        classes (np.ndarray): (N,) class IDs.
+        tile_ids (np.ndarray): (N,) index of the tile each box came from.
+
+    Returns:
+        np.ndarray: Indices of the boxes to keep.
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    areas = np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+    order = np.argsort(-scores)
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+
+        inter_w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        inter_h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        smaller = np.maximum(np.minimum(areas[i], areas[rest]), 1e-6)
+        duplicate = (
+            (inter_w * inter_h / smaller > threshold)
+            & (classes[rest] == classes[i])
+            & (tile_ids[rest] != tile_ids[i])
+        )
+        order = rest[~duplicate]
+    return np.array(keep, dtype=np.int64)